@@ -3,15 +3,16 @@ Module for calculating various experimental metrics.
 Includes functions for:
   - Synchronizing NaNs between paired dataframes
   - Calculate center of mass
-  - Filtering continuous data fragments
+  - Filtering continuous data fragments (with a table of the kept fragments)
   - Calculating heading velocity
   - Applying pixel size conversion to numerical data
   - Filtering speeds by threshold
   - Calculating Euclidean distance between frames
   - Calculating angles (in radians) from paired coordinates
-  - Computing probability of angle values within bounds over time windows
+  - Computing probability of angle values within bounds (one or many bins) over time windows
   - Calculating angular velocity (omega)
-  - Computing Mean Squared Displacement (MSD) using a sliding window
+  - Fused single-pass kinematics (center of mass, step distance, speed, heading angle, angular velocity)
+  - Computing Mean Squared Displacement (MSD) for all lags at once (FFT), pooled or per track
 """
 
 import numpy as np
@@ -35,14 +36,29 @@ def calculate_center_of_mass(df_b, df_p):
     return com_df
 
 
-def filter_continuous_fragments(df, min_length=10):
-   filtered_df = pd.DataFrame(index=df.index, columns=df.columns)
-    for i, row in df.iterrows():
-        valid = row.notna()
-        fragments = valid.astype(int).groupby((valid != valid.shift()).cumsum()).transform('sum')
-        mask = fragments >= min_length
-        filtered_df.loc[i] = row.where(mask, np.nan)
-    return filtered_df
+def find_fragments(valid):
+    # Run boundaries of True values along each row; `end` is exclusive
+    edges = np.diff(np.pad(valid.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    track, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    return track, start, end
+
+def fragment_mask(valid, min_length=10):
+    track, start, end = find_fragments(valid)
+    keep = (end - start) >= min_length
+    track, start, end = track[keep], start[keep], end[keep]
+    marks = np.zeros((valid.shape[0], valid.shape[1] + 1), dtype=np.int32)
+    np.add.at(marks, (track, start), 1)
+    np.add.at(marks, (track, end), -1)
+    return np.cumsum(marks[:, :-1], axis=1) > 0, (track, start, end)
+
+def filter_continuous_fragments(df, min_length=10, return_fragments=False):
+    mask, (track, start, end) = fragment_mask(df.notna().to_numpy(), min_length)
+    filtered_df = df.where(mask, np.nan)
+    if not return_fragments:
+        return filtered_df
+    fragments = pd.DataFrame({'track': df.index[track], 'start': start, 'end': end, 'length': end - start})
+    return filtered_df, fragments
 
 def calculate_heading_velocity(x_df, y_df, exposure_time, col_start=2):
     dx = x_df.iloc[:, col_start:-1].diff(axis=1)
@@ -73,23 +89,51 @@ def calculate_angles(x_p, y_p, x_b, y_b, offset=0.061, col_start=2):
     ) + offset
     return np.mod(angles, 2 * np.pi)
 
+def window_occupancy(values, bins, time_window_size):
+    # Per-timepoint in-bin and valid counts summed over rows: (bins, windows, window_size) and (windows, window_size)
+    num_windows = values.shape[1] // time_window_size
+    windows = values[:, :num_windows * time_window_size].reshape(values.shape[0], num_windows, time_window_size)
+    valid_counts = (~np.isnan(windows)).sum(axis=0)
+    in_bin_counts = np.stack([((windows >= lower) & (windows <= upper)).sum(axis=0) for lower, upper in bins])
+    return in_bin_counts, valid_counts
+
+def _window_probability(values, bounds, time_window_size):
+    in_bin_counts, valid_counts = window_occupancy(values, bounds, time_window_size)
+    # Per-timepoint probability, NaN where no track is valid, then averaged over each window
+    with np.errstate(invalid='ignore', divide='ignore'):
+        per_timepoint = np.where(valid_counts > 0, in_bin_counts / valid_counts, np.nan)
+    valid_windows = (valid_counts > 0).any(axis=1)
+    prob = np.full(per_timepoint.shape[:2], np.nan)
+    prob[:, valid_windows] = np.nanmean(per_timepoint[:, valid_windows], axis=2)
+    return prob
+
+def _probability_table(prob, bounds):
+    num_windows = prob.shape[1]
+    return pd.DataFrame({
+        'Window': np.tile(np.arange(num_windows), len(bounds)),
+        'Bin_lower': np.repeat(bounds[:, 0], num_windows),
+        'Bin_upper': np.repeat(bounds[:, 1], num_windows),
+        'Probability': prob.ravel(),
+    })
+
+def calculate_probability_bins(angles_df, bins, time_window_size,
+                               cat_columns=['Experiment', 'Stimulus_Strength', 'Count_cat'], group_by=None):
+    time_cols = [col for col in angles_df.columns if col not in cat_columns]
+    groups = [(None, angles_df)] if group_by is None else angles_df.groupby(group_by, sort=False, observed=True)
+    bounds = np.asarray(bins, dtype=float).reshape(-1, 2)
+    tables = []
+    for _, group in groups:
+        prob = _window_probability(group[time_cols].to_numpy(dtype=float), bounds, time_window_size)
+        table = _probability_table(prob, bounds)
+        for col in reversed([c for c in cat_columns if c in group.columns]):
+            table.insert(0, col, group[col].iloc[0])
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
 def calculate_probability(angles_df, angle_lower_deg, angle_upper_deg, time_window_size,
                           cat_columns=['Experiment', 'Stimulus_Strength', 'Count_cat']):
-    time_cols = [col for col in angles_df.columns if col not in cat_columns]
-    num_timepoints = len(time_cols)
-    num_windows = num_timepoints // time_window_size
-    prob_list = []
-    for i in range(num_windows):
-        start = i * time_window_size
-        end = start + time_window_size
-        window_data = angles_df[time_cols[start:end]]
-        # Calculate per-column probability, then average over the window
-        prob = window_data.apply(
-            lambda col: np.nan if col.isna().all() else np.sum((col >= angle_lower_deg) & (col <= angle_upper_deg)) / col.notna().sum(),
-            axis=0
-        ).mean()
-        prob_list.append(prob)
-    prob_df = pd.DataFrame([prob_list], columns=[f'Window_{i}' for i in range(num_windows)])
+    prob = calculate_probability_bins(angles_df, [(angle_lower_deg, angle_upper_deg)], time_window_size, cat_columns)
+    prob_df = pd.DataFrame([prob['Probability'].to_numpy()], columns=[f'Window_{i}' for i in range(len(prob))])
     for col in cat_columns:
         prob_df[col] = angles_df[col].iloc[0]
     return prob_df
@@ -99,22 +143,181 @@ def calculate_omega(angles_df, dt, col_start=1):
     omega_values = omega_values.astype(float)
     return omega_values[~omega_values.isna().all(axis=1)]
 
+def calculate_kinematics(x_p, y_p, x_b, y_b, exposure_time, offset=0.061):
+    # Fused per-frame metrics on (track x frame) arrays. Only the six outputs are allocated: intermediate
+    # results are written into the output buffers, and NaN in any coordinate propagates to every metric.
+    x_p, y_p, x_b, y_b = (np.asarray(a, dtype=float) for a in (x_p, y_p, x_b, y_b))
+    com_x = np.add(x_p, x_b)
+    com_x *= 0.5
+    com_y = np.add(y_p, y_b)
+    com_y *= 0.5
+
+    distance = np.empty_like(com_x)
+    speed = np.empty_like(com_x)
+    distance[:, 0] = speed[:, 0] = np.nan
+    np.subtract(com_x[:, 1:], com_x[:, :-1], out=distance[:, 1:])
+    np.square(distance[:, 1:], out=distance[:, 1:])
+    np.subtract(com_y[:, 1:], com_y[:, :-1], out=speed[:, 1:])
+    np.square(speed[:, 1:], out=speed[:, 1:])
+    distance[:, 1:] += speed[:, 1:]
+    np.sqrt(distance, out=distance)
+    np.divide(distance, exposure_time, out=speed)
+
+    angle = np.subtract(x_p, x_b)
+    omega = np.subtract(y_p, y_b)
+    np.arctan2(angle, omega, out=angle)
+    angle += offset
+    np.mod(angle, 2 * np.pi, out=angle)
+    # Angular steps are unwrapped into [-pi, pi) so crossing 0/2*pi does not show up as a full turn
+    omega[:, 0] = np.nan
+    np.subtract(angle[:, 1:], angle[:, :-1], out=omega[:, 1:])
+    omega[:, 1:] += np.pi
+    np.mod(omega[:, 1:], 2 * np.pi, out=omega[:, 1:])
+    omega[:, 1:] -= np.pi
+    omega[:, 1:] /= exposure_time
+    return {'com_x': com_x, 'com_y': com_y, 'distance': distance, 'speed': speed, 'angle': angle, 'omega': omega}
+
+def _lagged_products(a, b, max_lag, weights=None):
+    # out[..., w] = sum_i weights_i * sum_t a[..., i, t] * b[..., i, t - w] for w = 0..max_lag.
+    # Padding to N + max_lag keeps the needed lags free of wrap-around; the feature sum is taken in the
+    # frequency domain so only one inverse FFT is needed.
+    nfft = 1 << int(np.ceil(np.log2(a.shape[-1] + max_lag)))
+    spectrum = np.fft.rfft(a, nfft) * np.conj(np.fft.rfft(b, nfft))
+    if weights is not None:
+        spectrum *= weights[:, None]
+    return np.fft.irfft(spectrum.sum(axis=-2), nfft)[..., 1:max_lag + 1]
+
+def _pair_products(F, G, P, Q, symmetric=False):
+    # Features of the product of two lagged expansions sum_i F_i(t) G_i(t - w) * sum_j P_j(t) Q_j(t - w); for the
+    # square of one expansion only the (i <= j) pairs are kept, with weight 2 off the diagonal
+    if symmetric:
+        i, j = np.triu_indices(F.shape[1])
+        return F[:, i] * F[:, j], G[:, i] * G[:, j], np.where(i == j, 1.0, 2.0)
+    i, j = np.repeat(np.arange(F.shape[1]), P.shape[1]), np.tile(np.arange(P.shape[1]), F.shape[1])
+    return F[:, i] * P[:, j], G[:, i] * Q[:, j], None
+
+def msd_sufficient_stats(com_x, com_y, max_lag=None, chunk_size=256):
+    # Per track and lag: sum of the squared displacements, sum of their squared deviations from the track's
+    # mean at that lag (M2) and the number of valid pairs
+    x = np.asarray(com_x, dtype=float)
+    y = np.asarray(com_y, dtype=float)
+    n_tracks, N = x.shape
+    max_lag = N // 2 if max_lag is None else min(max_lag, N - 1)
+    sums = np.zeros((n_tracks, max_lag))
+    m2 = np.zeros((n_tracks, max_lag))
+    counts = np.zeros((n_tracks, max_lag), dtype=np.int64)
+    lags = np.arange(1, max_lag + 1)
+
+    for lo in range(0, n_tracks, chunk_size):
+        xc, yc = x[lo:lo + chunk_size], y[lo:lo + chunk_size]
+        valid = ~(np.isnan(xc) | np.isnan(yc))
+        m = valid.astype(float)
+        # Displacements are translation invariant, so centre each track to keep the expansion well conditioned
+        xc, yc, tc = (np.where(valid, a, 0.0) for a in (xc, yc, np.broadcast_to(np.arange(N, dtype=float), xc.shape)))
+        n_valid = np.maximum(m.sum(axis=1, keepdims=True), 1.0)
+        xc, yc, tc = (np.where(valid, a - a.sum(axis=1, keepdims=True) / n_valid, 0.0) for a in (xc, yc, tc))
+        # Split every track into a straight line and a residual, x = x0 + v t + xr. Then d^2 = A + 2w B + w^2 |v|^2
+        # with A = |dxr|^2 and B = v . dxr: the spread of d^2 only involves the residuals, so the M2 does not come
+        # from the difference of two large sums on directed (ballistic) tracks
+        stt = (tc ** 2).sum(axis=1, keepdims=True)
+        vx = np.divide((tc * xc).sum(axis=1, keepdims=True), stt, out=np.zeros_like(stt), where=stt > 0)
+        vy = np.divide((tc * yc).sum(axis=1, keepdims=True), stt, out=np.zeros_like(stt), where=stt > 0)
+        xr, yr = xc - vx * tc, yc - vy * tc
+        u = vx * xr + vy * yr
+        r = xr ** 2 + yr ** 2
+        # A(t, t - w) = sum_i F_i(t) * G_i(t - w) and B = sum_j P_j(t) * Q_j(t - w); every feature is zero on invalid frames
+        F, G = np.stack([r, m, xr, yr], axis=1), np.stack([m, r, -2 * xr, -2 * yr], axis=1)
+        P, Q = np.stack([u, m], axis=1), np.stack([m, -u], axis=1)
+        n_pairs = np.rint(_lagged_products(m[:, None], m[:, None], max_lag)).astype(np.int64)
+        a = _lagged_products(F, G, max_lag)
+        b = _lagged_products(P, Q, max_lag)
+        aa, ab, bb = (_lagged_products(fa, fb, max_lag, w) for fa, fb, w in
+                      (_pair_products(F, G, F, G, symmetric=True), _pair_products(F, G, P, Q),
+                       _pair_products(P, Q, P, Q, symmetric=True)))
+        # Deviations from w^2 |v|^2, whose mean is small next to their spread
+        e_sum = a + 2 * lags * b
+        e_sq = aa + 4 * lags * ab + 4 * lags ** 2 * bb
+
+        empty = n_pairs == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sums[lo:lo + chunk_size] = np.where(empty, 0.0, np.maximum(e_sum + lags ** 2 * (vx ** 2 + vy ** 2) * n_pairs, 0.0))
+            m2[lo:lo + chunk_size] = np.where(empty, 0.0, np.maximum(e_sq - e_sum ** 2 / n_pairs, 0.0))
+        counts[lo:lo + chunk_size] = n_pairs
+    return sums, m2, counts
+
+def pool_msd_stats(sums, m2, counts):
+    # Pools per-track (or per-chunk) MSD statistics over the first axis. The M2 of the pooled set is the sum of the
+    # M2s plus the spread of the track means around the pooled mean (Chan et al.), so no large sums are subtracted
+    sums, m2, counts = np.asarray(sums, dtype=float), np.asarray(m2, dtype=float), np.asarray(counts)
+    total, n = sums.sum(axis=0), counts.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spread = np.where(counts > 0, counts * (sums / counts - total / n) ** 2, 0.0)
+    return total, m2.sum(axis=0) + spread.sum(axis=0), n
+
+def _msd_table(sums, m2, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        msd = sums / counts
+        sem = np.sqrt(m2 / counts) / np.sqrt(counts)
+    return msd, sem
+
+def calculate_msd(com_x, com_y, max_lag=None, per_track=False):
+    sums, m2, counts = msd_sufficient_stats(com_x, com_y, max_lag)
+    lags = np.arange(1, counts.shape[1] + 1)
+    if per_track:
+        msd, sem = _msd_table(sums, m2, counts)
+        tracks = com_x.index if isinstance(com_x, pd.DataFrame) else np.arange(counts.shape[0])
+        index = pd.MultiIndex.from_product([tracks, lags], names=['Track', 'Lag'])
+        return pd.DataFrame({'MSD': msd.ravel(), 'SEM': sem.ravel(), 'Count': counts.ravel()}, index=index)
+    sums, m2, counts = pool_msd_stats(sums, m2, counts)
+    msd, sem = _msd_table(sums, m2, counts)
+    return pd.DataFrame({'MSD': msd, 'SEM': sem, 'Count': counts}, index=pd.Index(lags, name='Lag'))
+
 def calculate_single_msd(com_x, com_y):
-    N = com_x.shape[1]
-    max_window = N // 2
-    SW = np.zeros(max_window)
-    SWe = np.zeros(max_window)
-    for wind in range(1, max_window + 1):
-        displacements = []
-        for t in range(wind, N):
-            dx = com_x.iloc[:, t] - com_x.iloc[:, t - wind]
-            dy = com_y.iloc[:, t] - com_y.iloc[:, t - wind]
-            d2 = dx**2 + dy**2
-            displacements.extend(d2.dropna().values)
-        if displacements:
-            SW[wind - 1] = np.mean(displacements)
-            SWe[wind - 1] = np.std(displacements) / np.sqrt(len(displacements))
-        else:
-            SW[wind - 1] = np.nan
-            SWe[wind - 1] = np.nan
-    return SW, SWe
+    msd = calculate_msd(com_x, com_y)
+    return msd['MSD'].to_numpy(), msd['SEM'].to_numpy()
+
+# Adapters for trajectory_set.TrajectorySet: they work on the (track x frame) coordinate views directly
+# and keep the metadata in ts.meta, so no metadata columns have to be sliced off or re-attached.
+
+def trajectory_center_of_mass(ts):
+    com_x = (np.nan_to_num(ts.x('backtrunk')) + np.nan_to_num(ts.x('palp'))) / 2
+    com_y = (np.nan_to_num(ts.y('backtrunk')) + np.nan_to_num(ts.y('palp'))) / 2
+    com_x[com_x == 0] = np.nan
+    com_y[com_y == 0] = np.nan
+    return com_x, com_y
+
+def trajectory_filter_fragments(ts, min_length=10):
+    mask, _ = fragment_mask(ts.valid_mask(), min_length)
+    coords = np.where(mask[:, :, None, None], ts.coords, np.nan)
+    return type(ts)(coords, ts.meta, ts.bodyparts)
+
+def trajectory_distance(ts, bodypart='backtrunk'):
+    dx = np.diff(ts.x(bodypart), axis=1, prepend=np.nan)
+    dy = np.diff(ts.y(bodypart), axis=1, prepend=np.nan)
+    return np.sqrt(dx**2 + dy**2)
+
+def trajectory_heading_velocity(ts, exposure_time, bodypart='backtrunk'):
+    return trajectory_distance(ts, bodypart) / exposure_time
+
+def trajectory_angles(ts, offset=0.061):
+    angles = np.arctan2(ts.x('palp') - ts.x('backtrunk'), ts.y('palp') - ts.y('backtrunk')) + offset
+    return np.mod(angles, 2 * np.pi)
+
+def trajectory_kinematics(ts, exposure_time, offset=0.061):
+    return calculate_kinematics(ts.x('palp'), ts.y('palp'), ts.x('backtrunk'), ts.y('backtrunk'), exposure_time, offset)
+
+def trajectory_probability(ts, bins, time_window_size, group_by=['Experiment', 'Stimulus_Strength'], offset=0.061):
+    angles = trajectory_angles(ts, offset)
+    bounds = np.asarray(bins, dtype=float).reshape(-1, 2)
+    groups = [((), np.arange(len(ts)))] if group_by is None else ts.groups(group_by).items()
+    tables = []
+    for key, rows in groups:
+        table = _probability_table(_window_probability(angles[rows], bounds, time_window_size), bounds)
+        for col, value in reversed(list(zip(group_by or [], np.atleast_1d(key)))):
+            table.insert(0, col, value)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+def trajectory_msd(ts, max_lag=None, per_track=False):
+    com_x, com_y = trajectory_center_of_mass(ts)
+    return calculate_msd(com_x, com_y, max_lag=max_lag, per_track=per_track)
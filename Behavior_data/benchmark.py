@@ -0,0 +1,184 @@
+"""
+Synthetic-data benchmark for the behavior pipeline.
+Generates DLC-style multi-individual CSV files (random-walk larvae with NaN gaps and jitter), times every
+stage of data_loading_processing / data_organizing and the behavior_metrics functions across sizes,
+and writes the results as JSON so throughput and memory can be compared across versions.
+
+Usage: python benchmark.py --sizes 10x2000x4 50x10000x8 --output bench.json
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import io
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+if __name__ == '__main__':
+    # Run as a script: the shared instrumentation module lives in the repository root
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_loading_processing as dlp
+import data_organizing as org
+import behavior_metrics as bm
+
+BODYPARTS = ('palp', 'backtrunk', 'tail')
+
+def generate_dlc_csv(path, n_individuals=10, n_frames=2000, nan_fraction=0.05, jitter=0.5, body_length=12.0,
+                     seed=0, bodyparts=BODYPARTS):
+    rng = np.random.default_rng(seed)
+    # Heading follows a slow random walk, the body centre moves along it inside a 1200 x 1200 px arena
+    heading = np.cumsum(rng.normal(0, 0.05, (n_frames, n_individuals)), axis=0) + rng.uniform(0, 2 * np.pi, n_individuals)
+    steps = rng.gamma(2.0, 0.5, (n_frames, n_individuals))
+    centre_x = np.clip(rng.uniform(150, 1050, n_individuals) + np.cumsum(steps * np.sin(heading), axis=0), 0, 1200)
+    centre_y = np.clip(rng.uniform(150, 1050, n_individuals) + np.cumsum(steps * np.cos(heading), axis=0), 0, 1200)
+    offsets = {bp: (0.5 - i / max(len(bodyparts) - 1, 1)) * body_length for i, bp in enumerate(bodyparts)}
+
+    # NaN gaps come in runs, as lost detections do, rather than as isolated frames
+    gaps = np.zeros((n_frames, n_individuals), dtype=bool)
+    n_gaps = int(nan_fraction * n_frames * n_individuals / 10)
+    for frame, individual, length in zip(rng.integers(0, n_frames, n_gaps), rng.integers(0, n_individuals, n_gaps),
+                                         rng.geometric(0.1, n_gaps)):
+        gaps[frame:frame + length, individual] = True
+
+    columns = [(f'individual{i + 1}', bp, c) for i in range(n_individuals) for bp in bodyparts
+               for c in ('x', 'y', 'likelihood')]
+    values = np.empty((n_frames, len(columns)))
+    for col, (individual, bp, coord) in enumerate(columns):
+        i = int(individual[len('individual'):]) - 1
+        if coord == 'likelihood':
+            values[:, col] = rng.uniform(0.6, 1.0, n_frames)
+            continue
+        centre, trig = (centre_x, np.sin) if coord == 'x' else (centre_y, np.cos)
+        values[:, col] = centre[:, i] + offsets[bp] * trig(heading[:, i]) + rng.normal(0, jitter, n_frames)
+    values[np.repeat(gaps, 3 * len(bodyparts), axis=1)] = np.nan
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['scorer'] + ['DLC_synthetic'] * len(columns))
+        writer.writerow(['individuals'] + [c[0] for c in columns])
+        writer.writerow(['bodyparts'] + [c[1] for c in columns])
+        writer.writerow(['coords'] + [c[2] for c in columns])
+    pd.DataFrame(values).to_csv(path, mode='a', header=False, float_format='%.4f')
+    return path
+
+def generate_campaign(root, n_individuals, n_frames, n_files, strengths=('75', '150', '300'), seed=0, **kwargs):
+    paths = []
+    for k in range(n_files):
+        folder = os.path.join(root, strengths[k % len(strengths)], 'day1')
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'synthetic{k:03d}_filtered.csv')
+        paths.append(generate_dlc_csv(path, n_individuals, n_frames, seed=seed + k, **kwargs))
+    return paths
+
+def measure(func, *args, repeat=1, measure_memory=True, **kwargs):
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            timings.append(time.perf_counter() - start)
+        peak_mb = None
+        if measure_memory:
+            tracemalloc.start()
+            func(*args, **kwargs)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+    return result, {'seconds': min(timings), 'seconds_all': timings, 'peak_mb': peak_mb}
+
+def run_size(workdir, n_individuals, n_frames, n_files, repeat=1, measure_memory=True, rate=5, window=60):
+    size = {'n_individuals': n_individuals, 'n_frames': n_frames, 'n_files': n_files}
+    raw_dir, out_dir = os.path.join(workdir, 'raw'), os.path.join(workdir, 'processed')
+    files = generate_campaign(raw_dir, n_individuals, n_frames, n_files)
+    for file in files:
+        os.makedirs(os.path.join(out_dir, os.path.relpath(os.path.dirname(file), raw_dir)), exist_ok=True)
+    input_bytes = sum(os.path.getsize(f) for f in files)
+    results = []
+
+    def record(stage, stats, rows):
+        results.append(dict(size, stage=stage, rows=rows, rows_per_second=rows / stats['seconds'] if stats['seconds'] else None,
+                            **stats))
+
+    def process_files(output_format):
+        for file in files:
+            target = os.path.join(out_dir, os.path.relpath(os.path.dirname(file), raw_dir))
+            dlp.process_csv_file(file, target, [], rate=rate, output_format=output_format)
+
+    _, stats = measure(dlp.read_dlc_csv, files[0], rate=rate, repeat=repeat, measure_memory=measure_memory)
+    record('read_dlc_csv', stats, n_frames // rate)
+    _, stats = measure(process_files, 'both', repeat=repeat, measure_memory=measure_memory)
+    stats['input_bytes'] = input_bytes
+    record('process_csv_file', stats, n_files * n_frames)
+    for source in ('csv', 'npz'):
+        merged, stats = measure(org.process_all, out_dir, source=source, repeat=repeat, measure_memory=measure_memory)
+        record(f'process_all[{source}]', stats, len(merged[0]))
+
+    X_b, Y_b, X_p, Y_p = merged
+    x_b, y_b, x_p, y_p = (df.iloc[:, 2:].to_numpy(dtype=float) for df in merged)
+    n_tracks = len(X_b)
+    angles = bm.calculate_angles(X_p, Y_p, X_b, Y_b)
+    angles_df = pd.concat([X_b[['Experiment', 'Stimulus_Strength']].astype(object), angles], axis=1)
+    edges = np.linspace(0, 2 * np.pi, 37)
+    com_x, com_y = (x_b + x_p) / 2, (y_b + y_p) / 2
+
+    metrics = [
+        ('calculate_center_of_mass', bm.calculate_center_of_mass, (X_b.iloc[:, 2:], X_p.iloc[:, 2:]), {}),
+        ('filter_continuous_fragments', bm.filter_continuous_fragments, (X_b.iloc[:, 2:],), {}),
+        ('calculate_angles', bm.calculate_angles, (X_p, Y_p, X_b, Y_b), {}),
+        ('calculate_distance', bm.calculate_distance, (X_b, Y_b), {}),
+        ('calculate_kinematics', bm.calculate_kinematics, (x_p, y_p, x_b, y_b, 0.2), {}),
+        ('calculate_probability', bm.calculate_probability, (angles_df, 0, np.pi / 2, window),
+         {'cat_columns': ['Experiment', 'Stimulus_Strength']}),
+        ('calculate_probability_bins[36]', bm.calculate_probability_bins,
+         (angles_df, list(zip(edges[:-1], edges[1:])), window), {'cat_columns': ['Experiment', 'Stimulus_Strength']}),
+        ('calculate_single_msd', bm.calculate_single_msd, (pd.DataFrame(com_x), pd.DataFrame(com_y)), {}),
+    ]
+    for stage, func, args, kwargs in metrics:
+        _, stats = measure(func, *args, repeat=repeat, measure_memory=measure_memory, **kwargs)
+        record(stage, stats, n_tracks)
+    return results
+
+def run_benchmarks(sizes, output=None, repeat=1, measure_memory=True, workdir=None):
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'results': [],
+    }
+    for n_individuals, n_frames, n_files in sizes:
+        with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+            print(f"Benchmarking {n_individuals} individuals x {n_frames} frames x {n_files} files")
+            for result in run_size(tmp, n_individuals, n_frames, n_files, repeat, measure_memory):
+                print(f"  {result['stage']:<32} {result['seconds']:8.3f} s"
+                      + (f"  {result['peak_mb']:8.1f} MB" if result['peak_mb'] is not None else ''))
+                report['results'].append(result)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results saved to {output}")
+    return report
+
+def parse_size(text):
+    n_individuals, n_frames, n_files = (int(v) for v in text.lower().split('x'))
+    return n_individuals, n_frames, n_files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(10, 2000, 3), (30, 10000, 6)],
+                        help='individuals x frames x files, e.g. 10x2000x3')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass for peak memory')
+    parser.add_argument('--workdir', default=None, help='where the temporary synthetic data is written')
+    args = parser.parse_args()
+    run_benchmarks(args.sizes, args.output, args.repeat, not args.no_memory, args.workdir)
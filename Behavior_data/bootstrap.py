@@ -0,0 +1,138 @@
+"""
+Bootstrap confidence intervals for the angle-probability windows and MSD curves.
+Per-track sufficient statistics (in-bin and valid counts for every window timepoint, MSD sums and counts for every
+lag) are computed once; a replicate is then a multiplicity vector over tracks (or over whole experiments), and all
+replicates of a block are evaluated with one matrix product. Blocks run in a process pool, each with its own
+SeedSequence stream, so results depend on the seed but not on the number of workers.
+
+    ts = TrajectorySet.from_frames(*process_all(parent_dir))
+    bootstrap_probability(ts, [(0, np.pi / 2)], 60, unit='Experiment', n_replicates=2000, seed=1)
+    bootstrap_msd(ts, max_lag=100, n_replicates=2000, seed=1)
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import behavior_metrics as bm
+
+_worker_arrays = None
+
+def track_window_counts(ts, bins, time_window_size, offset=0.061):
+    # Per track: in-bin indicator (track, bin, window * window_size) and valid indicator (track, window * window_size)
+    angles = bm.trajectory_angles(ts, offset)
+    bounds = np.asarray(bins, dtype=float).reshape(-1, 2)
+    n_used = angles.shape[1] // time_window_size * time_window_size
+    angles = angles[:, :n_used]
+    in_bin = np.stack([(angles >= lower) & (angles <= upper) for lower, upper in bounds], axis=1)
+    return in_bin.astype(np.float32), (~np.isnan(angles)).astype(np.float32)
+
+def track_msd_stats(ts, max_lag=None):
+    com_x, com_y = bm.trajectory_center_of_mass(ts)
+    sums, _, counts = bm.msd_sufficient_stats(com_x, com_y, max_lag)
+    return sums, counts.astype(np.float64)
+
+def probability_from_counts(in_bin, valid, n_bins, time_window_size):
+    # in_bin (replicate, bin * timepoint) and valid (replicate, timepoint) summed over tracks -> (replicate, bin, window)
+    n_rep = in_bin.shape[0]
+    in_bin = in_bin.reshape(n_rep, n_bins, -1, time_window_size)
+    valid = valid.reshape(n_rep, 1, -1, time_window_size)
+    has_valid = valid > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        per_timepoint = np.where(has_valid, in_bin / valid, 0.)
+        return per_timepoint.sum(axis=3) / has_valid.sum(axis=3)
+
+def msd_from_sums(sums, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+def _seed_sequence(seed):
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+def _init_worker(arrays):
+    global _worker_arrays
+    _worker_arrays = arrays
+
+def _replicate_block(seed, n_replicates, track_units, n_units, metric, metric_args, arrays=None):
+    arrays = _worker_arrays if arrays is None else arrays
+    rng = np.random.default_rng(seed)
+    unit_counts = rng.multinomial(n_units, np.full(n_units, 1. / n_units), size=n_replicates)
+    weights = unit_counts[:, track_units]
+    return metric(*(weights.astype(a.dtype) @ a for a in arrays), *metric_args)
+
+def bootstrap_replicates(arrays, metric, units, n_replicates=1000, seed=None, n_workers=1, block_size=250,
+                         metric_args=()):
+    # arrays: per-track statistics (track, ...), summed with the replicate multiplicities and passed to
+    # metric(*sums, *metric_args); units: resampling unit of every track (track index or experiment label)
+    arrays = [np.ascontiguousarray(a.reshape(a.shape[0], -1)) for a in arrays]
+    track_units, unique_units = pd.factorize(pd.Series(units))
+    sizes = [min(block_size, n_replicates - lo) for lo in range(0, n_replicates, block_size)]
+    seeds = _seed_sequence(seed).spawn(len(sizes))
+    jobs = [(s, size, track_units, len(unique_units), metric, metric_args) for s, size in zip(seeds, sizes)]
+    if n_workers == 1:
+        blocks = [_replicate_block(*job, arrays=arrays) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(arrays,)) as executor:
+            blocks = list(executor.map(_replicate_block, *zip(*jobs)))
+    return np.concatenate(blocks)
+
+def _groups(ts, group_by):
+    if group_by is None:
+        return [((), np.arange(len(ts)))]
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    return [(key if isinstance(key, tuple) else (key,), rows) for key, rows in ts.groups(group_by).items()]
+
+def _units(ts, rows, unit):
+    return rows if unit is None else ts.meta[unit].to_numpy()[rows]
+
+def _interval(replicates, ci):
+    tail = (100 - ci) / 2
+    with np.errstate(invalid='ignore'):
+        valid = ~np.isnan(replicates).all(axis=0)
+        lower, upper, se = (np.full(replicates.shape[1:], np.nan) for _ in range(3))
+        lower[valid], upper[valid] = np.nanpercentile(replicates[:, valid], [tail, 100 - tail], axis=0)
+        se[valid] = np.nanstd(replicates[:, valid], axis=0, ddof=1)
+    return lower, upper, se
+
+def _with_group_columns(table, group_by, key):
+    group_by = [] if group_by is None else [group_by] if isinstance(group_by, str) else list(group_by)
+    for col, value in reversed(list(zip(group_by, key))):
+        table.insert(0, col, value)
+    return table
+
+def bootstrap_probability(ts, bins, time_window_size, group_by='Stimulus_Strength', unit=None, n_replicates=1000,
+                          ci=95, seed=None, n_workers=1, offset=0.061):
+    # unit=None resamples individual tracks, unit='Experiment' resamples whole recordings
+    bounds = np.asarray(bins, dtype=float).reshape(-1, 2)
+    in_bin, valid = track_window_counts(ts, bounds, time_window_size, offset)
+    groups = _groups(ts, group_by)
+    seeds = _seed_sequence(seed).spawn(len(groups))
+    tables = []
+    for (key, rows), group_seed in zip(groups, seeds):
+        arrays = [in_bin[rows], valid[rows]]
+        args = (len(bounds), time_window_size)
+        point = probability_from_counts(in_bin[rows].sum(axis=0)[None].reshape(1, -1),
+                                        valid[rows].sum(axis=0)[None], *args)[0]
+        replicates = bootstrap_replicates(arrays, probability_from_counts, _units(ts, rows, unit), n_replicates,
+                                          group_seed, n_workers, metric_args=args)
+        lower, upper, se = _interval(replicates, ci)
+        table = bm._probability_table(point, bounds)
+        table['SE'], table['CI_lower'], table['CI_upper'] = se.ravel(), lower.ravel(), upper.ravel()
+        tables.append(_with_group_columns(table, group_by, key))
+    return pd.concat(tables, ignore_index=True)
+
+def bootstrap_msd(ts, max_lag=None, group_by='Stimulus_Strength', unit=None, n_replicates=1000, ci=95, seed=None,
+                  n_workers=1):
+    sums, counts = track_msd_stats(ts, max_lag)
+    groups = _groups(ts, group_by)
+    seeds = _seed_sequence(seed).spawn(len(groups))
+    tables = []
+    for (key, rows), group_seed in zip(groups, seeds):
+        point = msd_from_sums(sums[rows].sum(axis=0), counts[rows].sum(axis=0))
+        replicates = bootstrap_replicates([sums[rows], counts[rows]], msd_from_sums, _units(ts, rows, unit),
+                                          n_replicates, group_seed, n_workers)
+        lower, upper, se = _interval(replicates, ci)
+        table = pd.DataFrame({'Lag': np.arange(1, len(point) + 1), 'MSD': point, 'SE': se,
+                              'CI_lower': lower, 'CI_upper': upper})
+        tables.append(_with_group_columns(table, group_by, key))
+    return pd.concat(tables, ignore_index=True)
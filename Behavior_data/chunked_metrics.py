@@ -0,0 +1,216 @@
+"""
+Bounded-memory behavior metrics for campaigns that do not fit in RAM.
+The _sampled.npz recordings are copied once into a memory-mapped (track x frame x bodypart x xy) store; tracks are then
+streamed in chunks through the behavior_metrics functions and reduced with mergeable accumulators (probability
+window counts, MSD sums and counts, speed histograms). Peak memory depends on the chunk size, not on the campaign.
+
+    build_coordinate_store(processed_dir, 'store')
+    probability, msd = run_chunked('store', [ProbabilityAccumulator(bins, 60), MSDAccumulator()], chunk_size=256)
+    probability.result(), msd.result()
+"""
+
+import os
+import glob
+import copy
+import zipfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import behavior_metrics as bm
+from trajectory_set import TrajectorySet, BODYPARTS, META_COLUMNS
+
+COORDS_FILE = 'coords.npy'
+META_FILE = 'meta.csv'
+
+def _recording_shape(file):
+    # Reads only the .npy header of the coords array inside the .npz archive
+    with zipfile.ZipFile(file) as archive, archive.open('coords.npy') as f:
+        version = np.lib.format.read_magic(f)
+        reader = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, _ = reader(f)
+    return shape
+
+def build_coordinate_store(parent_dir, store_dir, dtype=np.float64, edge_cut=(100, 1100)):
+    # One stimulus folder per strength, as for data_organizing.process_all(source='npz'); edge_cut applies the same
+    # x-range filter process_all applies to the backtrunk and palp x planes (None keeps every value)
+    recordings = []
+    for folder in sorted(glob.glob(os.path.join(parent_dir, '*'))):
+        for file in sorted(glob.glob(os.path.join(folder, '**/*_sampled.npz'), recursive=True)):
+            recordings.append((file, os.path.basename(folder), _recording_shape(file)))
+    n_tracks = sum(shape[0] for _, _, shape in recordings)
+    n_frames = max((shape[1] for _, _, shape in recordings), default=0)
+
+    os.makedirs(store_dir, exist_ok=True)
+    coords = np.lib.format.open_memmap(os.path.join(store_dir, COORDS_FILE), mode='w+', dtype=dtype,
+                                       shape=(n_tracks, n_frames, len(BODYPARTS), 2))
+    experiments, strengths = [], []
+    row = 0
+    for file, strength, shape in recordings:
+        with np.load(file) as rec:
+            order = [list(rec['bodyparts']).index(bodypart) for bodypart in BODYPARTS]
+            block = rec['coords'][:, :, order].astype(dtype)
+            experiment = str(rec['experiment'])
+        if edge_cut is not None:
+            x = block[:, :, :, 0]
+            x[(x < edge_cut[0]) | (x > edge_cut[1])] = np.nan
+        coords[row:row + shape[0], :shape[1]] = block
+        coords[row:row + shape[0], shape[1]:] = np.nan
+        experiments += [experiment] * shape[0]
+        strengths += [strength] * shape[0]
+        row += shape[0]
+    coords.flush()
+    pd.DataFrame({'Experiment': experiments, 'Stimulus_Strength': strengths}).to_csv(
+        os.path.join(store_dir, META_FILE), index=False)
+    print(f"Coordinate store with {n_tracks} tracks x {n_frames} frames written to {store_dir}")
+    return open_coordinate_store(store_dir)
+
+def open_coordinate_store(store_dir):
+    coords = np.load(os.path.join(store_dir, COORDS_FILE), mmap_mode='r')
+    meta = pd.read_csv(os.path.join(store_dir, META_FILE), dtype=str).astype('category')
+    return TrajectorySet(coords, meta)
+
+def _group_rows(ts, group_by):
+    if group_by is None:
+        return [((), np.arange(len(ts)))]
+    return [(key if isinstance(key, tuple) else (key,), rows) for key, rows in ts.groups(group_by).items()]
+
+def _with_group_columns(table, group_by, key):
+    for col, value in reversed(list(zip(group_by or [], key))):
+        table.insert(0, col, value)
+    return table
+
+class GroupedAccumulator:
+    # Holds one tuple of additive statistics per group key; merging two partial results adds them element-wise
+    def __init__(self, group_by=None):
+        self.group_by = group_by
+        self.stats = {}
+
+    def _add(self, key, stats):
+        if key in self.stats:
+            self.stats[key] = tuple(a + b for a, b in zip(self.stats[key], stats))
+        else:
+            self.stats[key] = tuple(stats)
+
+    def empty_like(self):
+        # Same configuration without any data, e.g. the starting point of every run_chunked worker
+        clone = copy.copy(self)
+        clone.stats = {}
+        return clone
+
+    def merge(self, other):
+        for key, stats in other.stats.items():
+            self._add(key, stats)
+        return self
+
+class ProbabilityAccumulator(GroupedAccumulator):
+    # Per-group in-bin and valid counts for every (window, timepoint); result() gives the same table as
+    # behavior_metrics.trajectory_probability
+    def __init__(self, bins, time_window_size, group_by=META_COLUMNS, offset=0.061):
+        super().__init__(group_by)
+        self.bounds = np.asarray(bins, dtype=float).reshape(-1, 2)
+        self.time_window_size = time_window_size
+        self.offset = offset
+
+    def update(self, ts):
+        angles = bm.trajectory_angles(ts, self.offset)
+        for key, rows in _group_rows(ts, self.group_by):
+            self._add(key, bm.window_occupancy(angles[rows], self.bounds, self.time_window_size))
+
+    def result(self):
+        tables = []
+        for key, (in_bin, valid) in self.stats.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                per_timepoint = np.where(valid > 0, in_bin / valid, np.nan)
+            valid_windows = (valid > 0).any(axis=1)
+            prob = np.full(per_timepoint.shape[:2], np.nan)
+            prob[:, valid_windows] = np.nanmean(per_timepoint[:, valid_windows], axis=2)
+            tables.append(_with_group_columns(bm._probability_table(prob, self.bounds), self.group_by, key))
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+class MSDAccumulator(GroupedAccumulator):
+    # Pooled MSD statistics (sum, M2 and count of squared displacements per lag) per group; result() gives the same
+    # MSD/SEM/Count table as behavior_metrics.calculate_msd
+    def __init__(self, max_lag=None, group_by=None):
+        super().__init__(group_by)
+        self.max_lag = max_lag
+
+    def _add(self, key, stats):
+        # M2s are not additive: partial results are pooled like the tracks of one chunk
+        if key in self.stats:
+            stats = bm.pool_msd_stats(*(np.stack(pair) for pair in zip(self.stats[key], stats)))
+        self.stats[key] = tuple(stats)
+
+    def update(self, ts):
+        com_x, com_y = bm.trajectory_center_of_mass(ts)
+        for key, rows in _group_rows(ts, self.group_by):
+            self._add(key, bm.pool_msd_stats(*bm.msd_sufficient_stats(com_x[rows], com_y[rows], self.max_lag)))
+
+    def result(self):
+        tables = []
+        for key, (sums, m2, counts) in self.stats.items():
+            msd, sem = bm._msd_table(sums, m2, counts)
+            table = pd.DataFrame({'Lag': np.arange(1, len(counts) + 1), 'MSD': msd, 'SEM': sem, 'Count': counts})
+            tables.append(_with_group_columns(table, self.group_by, key))
+        if self.group_by is None and tables:
+            return tables[0].set_index('Lag')
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+class SpeedHistogram(GroupedAccumulator):
+    # Histogram of the centre-of-mass speed (behavior_metrics.calculate_kinematics) on fixed edges, plus count, sum
+    # and sum of squares for the mean and standard deviation; values outside the edges are counted separately
+    def __init__(self, edges, exposure_time, group_by=META_COLUMNS, offset=0.061):
+        super().__init__(group_by)
+        self.edges = np.asarray(edges, dtype=float)
+        self.exposure_time = exposure_time
+        self.offset = offset
+
+    def update(self, ts):
+        speed = bm.trajectory_kinematics(ts, self.exposure_time, self.offset)['speed']
+        for key, rows in _group_rows(ts, self.group_by):
+            values = speed[rows]
+            values = values[~np.isnan(values)]
+            counts, _ = np.histogram(values, self.edges)
+            outside = np.array([(values < self.edges[0]).sum(), (values > self.edges[-1]).sum()])
+            self._add(key, (counts, outside, len(values), values.sum(), (values ** 2).sum()))
+
+    def result(self):
+        # Long table: one row per group and bin, with the group's summary statistics repeated on every row
+        tables = []
+        for key, (counts, outside, n, total, total_sq) in self.stats.items():
+            mean = total / n if n else np.nan
+            std = np.sqrt(max(total_sq / n - mean ** 2, 0.)) if n else np.nan
+            table = pd.DataFrame({'Bin_lower': self.edges[:-1], 'Bin_upper': self.edges[1:], 'Count': counts,
+                                  'Below': outside[0], 'Above': outside[1], 'N': n, 'Mean': mean, 'Std': std})
+            tables.append(_with_group_columns(table, self.group_by, key))
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+def _run_range(store, accumulators, lo, hi, chunk_size, min_fragment_length):
+    if isinstance(store, str):
+        store = open_coordinate_store(store)
+    for start in range(lo, hi, chunk_size):
+        # A contiguous track range of the memory-mapped store; only this chunk is read into memory
+        chunk = store.take(np.arange(start, min(start + chunk_size, hi)))
+        chunk = TrajectorySet(np.asarray(chunk.coords), chunk.meta, chunk.bodyparts)
+        if min_fragment_length:
+            chunk = bm.trajectory_filter_fragments(chunk, min_fragment_length)
+        for accumulator in accumulators:
+            accumulator.update(chunk)
+    return accumulators
+
+def run_chunked(store, accumulators, chunk_size=256, min_fragment_length=None, n_workers=1):
+    # store is a store directory or an open TrajectorySet (serial only); with n_workers > 1 every worker reduces a block
+    # of contiguous tracks into empty clones of the accumulators and the partial results are merged into them here, so
+    # data already held by the accumulators is counted once, as in the serial path
+    n_tracks = len(open_coordinate_store(store) if isinstance(store, str) else store)
+    if n_workers == 1 or not isinstance(store, str):
+        return _run_range(store, accumulators, 0, n_tracks, chunk_size, min_fragment_length)
+    step = -(-n_tracks // n_workers)
+    ranges = [(lo, min(lo + step, n_tracks)) for lo in range(0, n_tracks, step)]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_run_range, store, [a.empty_like() for a in accumulators], lo, hi, chunk_size,
+                                   min_fragment_length) for lo, hi in ranges]
+        for future in futures:
+            for accumulator, partial in zip(accumulators, future.result()):
+                accumulator.merge(partial)
+    return accumulators
@@ -5,8 +5,19 @@ Module for loading, processing, and filtering (based on body size of the animal)
 import pandas as pd
 import numpy as np
 import os
+import sys
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
+if __name__ == '__main__':
+    # Run as a script: the shared instrumentation module lives in the repository root
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import stage, configure, get_records, add_records, print_summary
+
+MANIFEST_NAME = 'manifest.json'
+
 def create_output_folder(base_folder: str) -> str:
     base_output_path = os.path.join(base_folder, "Processed_Results")
     output_folder = os.path.join(base_output_path, datetime.today().strftime('%Y-%m-%d'))
@@ -14,83 +25,196 @@ def create_output_folder(base_folder: str) -> str:
     print(f"Output folder created: {output_folder}")
     return output_folder
 
+def output_paths(file: str, output_folder: str, output_format: str = 'csv') -> list:
+    base_name = os.path.splitext(os.path.basename(file))[0]
+    paths = []
+    if output_format in ('csv', 'both'):
+        paths += [os.path.join(output_folder, f'{base_name}_sampled_{plane}.csv') for plane in ('X_p', 'Y_p', 'X_b', 'Y_b')]
+    if output_format in ('npz', 'both'):
+        paths.append(os.path.join(output_folder, f'{base_name}_sampled.npz'))
+    return paths
+
+def save_recording(path: str, coords: np.ndarray, individual_ids: list, frames: np.ndarray,
+                   experiment: str, params: dict):
+    # coords is laid out as (individual, frame, bodypart, coord) so every coordinate plane is a plain view
+    np.savez(path, coords=coords, individuals=np.array(individual_ids, dtype=str), frames=frames,
+             bodyparts=np.array(['palp', 'backtrunk']), coord_names=np.array(['x', 'y']),
+             experiment=np.array(experiment), params=np.array(json.dumps(params, sort_keys=True)))
+
+def read_dlc_header(file: str):
+    with open(file, 'r', encoding='ISO-8859-1', newline='') as f:
+        reader = csv.reader(f)
+        rows = [row for _, row in zip(range(4), reader)]
+    if len(rows) < 4:
+        raise ValueError(f"Incomplete DLC header in {file}")
+    # Multi-animal DLC files have an extra 'individuals' row below the scorer row
+    if rows[1][0] == 'individuals':
+        return rows[1][1:], rows[2][1:], rows[3][1:], 4
+    return ['individual1'] * (len(rows[1]) - 1), rows[1][1:], rows[2][1:], 3
+
+def select_dlc_columns(file: str, bodyparts=('palp', 'backtrunk'), coords=('x', 'y')):
+    # (column, individual, bodypart, coord) for every requested column of the file, in file order
+    individuals, file_bodyparts, file_coords, header_rows = read_dlc_header(file)
+    selected = [(col + 1, ind, file_bodyparts[col], file_coords[col]) for col, ind in enumerate(individuals)
+                if file_bodyparts[col] in bodyparts and file_coords[col] in coords]
+    if not selected:
+        raise ValueError(f"No {list(bodyparts)} columns found in {file}")
+    individual_ids = list(dict.fromkeys(ind for _, ind, _, _ in selected))
+    return selected, individual_ids, header_rows
+
+def read_dlc_csv(file: str, bodyparts=('palp', 'backtrunk'), coords=('x', 'y'), rate: int = 1, dtype=np.float64):
+    selected, individual_ids, header_rows = select_dlc_columns(file, bodyparts, coords)
+
+    # Only the selected columns are parsed, every `rate`-th frame, straight into the requested dtype
+    body = pd.read_csv(file, header=None, encoding='ISO-8859-1',
+                       skiprows=lambda i: i < header_rows or (i - header_rows) % rate != 0,
+                       usecols=[0] + [col for col, _, _, _ in selected],
+                       dtype={col: dtype for col, _, _, _ in selected})
+    frames = body.pop(0).to_numpy(dtype=np.int64)
+
+    data = np.full((len(frames), len(individual_ids), len(bodyparts), len(coords)), np.nan, dtype=dtype)
+    ind_idx = [individual_ids.index(ind) for _, ind, _, _ in selected]
+    bp_idx = [bodyparts.index(bp) for _, _, bp, _ in selected]
+    coord_idx = [coords.index(c) for _, _, _, c in selected]
+    data[:, ind_idx, bp_idx, coord_idx] = body.to_numpy(dtype=dtype)
+    return data, individual_ids, frames
+
 def process_csv_file(file: str, output_folder: str, skipped_files: list, pixel_size: int = 25,
-                     rate: int = 5, distance_threshold_lower: int = 100, distance_threshold_upper: int = 500):
+                     rate: int = 5, distance_threshold_lower: int = 100, distance_threshold_upper: int = 500,
+                     output_format: str = 'csv', dtype=np.float64):
     try:
-        with open(file, 'r', encoding='ISO-8859-1') as f:
-            first_line = f.readline()
-            total_columns = len(first_line.split(',')) - 1
-
-        usecols_range = range(1, total_columns + 1)
-        df = pd.read_csv(file, header=None, skiprows=1, usecols=usecols_range,
-                         low_memory=False, encoding='ISO-8859-1')
-        df = df.dropna(axis=0, how='all').dropna(axis=1, how='all')
-        dt = df.T.copy()
-
-        x_p = dt[(dt[1] == "palp") & (dt[2] == "x")].iloc[:, 3:].T
-        y_p = dt[(dt[1] == "palp") & (dt[2] == "y")].iloc[:, 3:].T
-        x_b = dt[(dt[1] == "backtrunk") & (dt[2] == "x")].iloc[:, 3:].T
-        y_b = dt[(dt[1] == "backtrunk") & (dt[2] == "y")].iloc[:, 3:].T
-
-        individual_ids = dt[0].unique()
-        print(f"Processing file: {file}")
-        print(f"Number of individuals: {len(individual_ids)}")
-        x_p.columns = individual_ids
-        y_p.columns = individual_ids
-        x_b.columns = individual_ids
-        y_b.columns = individual_ids
-
-        x_p_sampled = x_p[::rate].astype(float)
-        y_p_sampled = y_p[::rate].astype(float)
-        x_b_sampled = x_b[::rate].astype(float)
-        y_b_sampled = y_b[::rate].astype(float)
-
-        distances_b_p = {}
-        for col in individual_ids:
-            curr_x_p = pd.to_numeric(x_p_sampled[col], errors='coerce')
-            curr_y_p = pd.to_numeric(y_p_sampled[col], errors='coerce')
-            curr_x_b = pd.to_numeric(x_b_sampled[col], errors='coerce')
-            curr_y_b = pd.to_numeric(y_b_sampled[col], errors='coerce')
-            dist_pb = np.sqrt((curr_x_p - curr_x_b) ** 2 + (curr_y_p - curr_y_b) ** 2) * pixel_size
-            distances_b_p[col] = dist_pb
-
-        distances_b_p_df = pd.DataFrame(distances_b_p)
-        mask = (distances_b_p_df >= distance_threshold_lower) & (distances_b_p_df <= distance_threshold_upper)
-
-        x_p_sampled = x_p_sampled.where(mask, np.nan).replace(0, np.nan)
-        y_p_sampled = y_p_sampled.where(mask, np.nan).replace(0, np.nan)
-        x_b_sampled = x_b_sampled.where(mask, np.nan).replace(0, np.nan)
-        y_b_sampled = y_b_sampled.where(mask, np.nan).replace(0, np.nan)
-
-        base_name = os.path.splitext(os.path.basename(file))[0]
-        print(f"Saving processed files for {base_name} to {output_folder}")
-        x_p_sampled.to_csv(os.path.join(output_folder, f'{base_name}_sampled_X_p.csv'))
-        y_p_sampled.to_csv(os.path.join(output_folder, f'{base_name}_sampled_Y_p.csv'))
-        x_b_sampled.to_csv(os.path.join(output_folder, f'{base_name}_sampled_X_b.csv'))
-        y_b_sampled.to_csv(os.path.join(output_folder, f'{base_name}_sampled_Y_b.csv'))
+        with stage('process_csv_file', file=file) as info:
+            data, individual_ids, frames = read_dlc_csv(file, bodyparts=('palp', 'backtrunk'), rate=rate, dtype=dtype)
+            info['rows'] = len(frames)
+            print(f"Processing file: {file}")
+            print(f"Number of individuals: {len(individual_ids)}")
+            x_p, y_p = data[:, :, 0, 0], data[:, :, 0, 1]
+            x_b, y_b = data[:, :, 1, 0], data[:, :, 1, 1]
+
+            distances_b_p = np.sqrt((x_p - x_b) ** 2 + (y_p - y_b) ** 2) * pixel_size
+            mask = (distances_b_p >= distance_threshold_lower) & (distances_b_p <= distance_threshold_upper)
+            data = np.where(mask[:, :, None, None] & (data != 0), data, np.nan)
+
+            base_name = os.path.splitext(os.path.basename(file))[0]
+            print(f"Saving processed files for {base_name} to {output_folder}")
+            paths = output_paths(file, output_folder, output_format)
+            if output_format in ('csv', 'both'):
+                planes = (data[:, :, 0, 0], data[:, :, 0, 1], data[:, :, 1, 0], data[:, :, 1, 1])
+                for plane, path in zip(planes, paths):
+                    pd.DataFrame(plane, index=frames, columns=individual_ids).to_csv(path)
+            if output_format in ('npz', 'both'):
+                params = {'pixel_size': pixel_size, 'rate': rate,
+                          'distance_threshold_lower': distance_threshold_lower,
+                          'distance_threshold_upper': distance_threshold_upper, 'dtype': np.dtype(dtype).name}
+                save_recording(paths[-1], np.ascontiguousarray(data.transpose(1, 0, 2, 3)), individual_ids,
+                               frames, base_name, params)
     except Exception as e:
         print(f"Error processing file {file}: {e}")
         skipped_files.append(file)
 
-def process_experiment_folder(experiment_folder: str):
-    skipped_files = []
-    output_folder = create_output_folder(experiment_folder)
+def find_dlc_files(experiment_folder: str) -> list:
+    csv_paths = []
     for root, dirs, files in os.walk(experiment_folder):
         for folder in dirs:
             folder_path = os.path.join(root, folder)
-            print("Processing folder:", folder_path)
-            csv_files = [f for f in os.listdir(folder_path) if f.endswith('_filtered.csv')]
-            for csv_file in csv_files:
-                csv_file_path = os.path.join(folder_path, csv_file)
-                print("Processing CSV file:", csv_file)
-                process_csv_file(csv_file_path, output_folder, skipped_files)
+            csv_files = sorted(f for f in os.listdir(folder_path) if f.endswith('_filtered.csv'))
+            csv_paths += [os.path.join(folder_path, f) for f in csv_files]
+    return csv_paths
+
+def load_manifest(manifest_path: str) -> dict:
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Could not read manifest {manifest_path}, starting a new one: {e}")
+        return {}
+
+def save_manifest(manifest_path: str, manifest: dict):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def file_signature(file: str, params: dict) -> dict:
+    stat = os.stat(file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'params': params}
+
+# Manifest entries are keyed by the absolute path of the input CSV and hold its size, mtime, the processing
+# parameters and the output folder it was written to. An entry is only written after the file was processed
+# without errors. The file is processed again when it has no entry, when its size or mtime changed, when any
+# parameter differs, or when one of its output files is missing from the recorded output folder. Moving the
+# input counts as a new file; a change to the processing code does not invalidate anything (use_manifest=False).
+def is_up_to_date(file: str, manifest: dict, params: dict) -> bool:
+    entry = manifest.get(os.path.abspath(file))
+    if entry is None:
+        return False
+    signature = file_signature(file, params)
+    if any(entry.get(key) != signature[key] for key in ('size', 'mtime', 'params')):
+        return False
+    return all(os.path.exists(path) for path in output_paths(file, entry['output_folder'], params['output_format']))
+
+def _process_csv_worker(file: str, output_folder: str, params: dict):
+    skipped_files = []
+    n_records = len(get_records())
+    process_csv_file(file, output_folder, skipped_files, **params)
+    return file, not skipped_files, get_records()[n_records:]
+
+def process_experiment_folder(experiment_folder: str, n_workers: int = 1, use_manifest: bool = True,
+                              pixel_size: int = 25, rate: int = 5, distance_threshold_lower: int = 100,
+                              distance_threshold_upper: int = 500, output_format: str = 'csv', dtype=np.float64):
+    skipped_files = []
+    output_folder = create_output_folder(experiment_folder)
+    params = {'pixel_size': pixel_size, 'rate': rate,
+              'distance_threshold_lower': distance_threshold_lower,
+              'distance_threshold_upper': distance_threshold_upper, 'output_format': output_format,
+              'dtype': np.dtype(dtype).name}
+
+    # The manifest lives next to the dated output folders so that it survives across days
+    manifest_path = os.path.join(os.path.dirname(output_folder), MANIFEST_NAME)
+    manifest = load_manifest(manifest_path) if use_manifest else {}
+
+    csv_paths = find_dlc_files(experiment_folder)
+    pending = [f for f in csv_paths if not (use_manifest and is_up_to_date(f, manifest, params))]
+    if len(pending) < len(csv_paths):
+        print(f"Skipping {len(csv_paths) - len(pending)} files already processed with the same parameters.")
+
+    def record(file, ok, records=()):
+        add_records(records)
+        if not ok:
+            skipped_files.append(file)
+        elif use_manifest:
+            manifest[os.path.abspath(file)] = dict(file_signature(file, params), output_folder=os.path.abspath(output_folder))
+            save_manifest(manifest_path, manifest)
+
+    if n_workers == 1:
+        for csv_file_path in pending:
+            print("Processing CSV file:", csv_file_path)
+            file, ok, _ = _process_csv_worker(csv_file_path, output_folder, params)
+            record(file, ok)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(_process_csv_worker, f, output_folder, params): f for f in pending}
+            for future in as_completed(futures):
+                try:
+                    record(*future.result())
+                except Exception as e:
+                    print(f"Error processing file {futures[future]}: {e}")
+                    skipped_files.append(futures[future])
+
     if skipped_files:
         print("\nThe following files were skipped due to errors:")
         for file in skipped_files:
             print(file)
     else:
         print("\nAll files processed successfully!")
+    return skipped_files
 
 if __name__ == '__main__':
     experiment_folder = ''
-    process_experiment_folder(experiment_folder)
+    n_workers = os.cpu_count()
+    configure(os.path.join(experiment_folder, 'Processed_Results', 'instrumentation.jsonl'))
+    with stage('process_experiment_folder'):
+        process_experiment_folder(experiment_folder, n_workers=n_workers)
+    print_summary()
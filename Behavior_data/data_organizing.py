@@ -3,9 +3,16 @@ Module for organizing, validating, and merging processed CSV files from stimulus
 """
 
 import os
+import sys
 import glob
 import pandas as pd
 import numpy as np
+from contextlib import contextmanager
+
+if __name__ == '__main__':
+    # Run as a script: the shared instrumentation module lives in the repository root
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import stage, configure, print_summary
 
 def validate_and_sort(files, expected=None, label=""):
     files = sorted(files)
@@ -13,7 +20,41 @@ def validate_and_sort(files, expected=None, label=""):
         print(f"[WARNING] Expected {expected} {label} files but found {len(files)}.")
     return files
 
-def process_stimulus_folder(stimulus_folder):
+def load_recording(path):
+    with np.load(path) as rec:
+        return {key: rec[key] for key in rec.files}
+
+def process_stimulus_folder_npz(stimulus_folder):
+    strength = os.path.basename(stimulus_folder)
+    files = sorted(glob.glob(os.path.join(stimulus_folder, '**/*_sampled.npz'), recursive=True))
+    dfs_X_b, dfs_Y_b, dfs_X_p, dfs_Y_p = [], [], [], []
+    for file in files:
+        exp = os.path.basename(file).split('_sampled')[0]
+        try:
+            with stage('read_recording', file=file) as info:
+                rec = load_recording(file)
+                info['rows'] = rec['coords'].shape[0]
+            exp = str(rec['experiment'])
+            coords, individuals = rec['coords'], rec['individuals']
+            bodyparts, coord_names = list(rec['bodyparts']), list(rec['coord_names'])
+            planes = []
+            for bodypart, coord in (('backtrunk', 'x'), ('backtrunk', 'y'), ('palp', 'x'), ('palp', 'y')):
+                # (individual, frame) view of one coordinate plane, rows are individuals as in the CSV route
+                plane = coords[:, :, bodyparts.index(bodypart), coord_names.index(coord)]
+                df = pd.DataFrame(plane, index=individuals, columns=range(coords.shape[1]))
+                df['Experiment'], df['Stimulus_Strength'] = exp, strength
+                planes.append(df)
+            dfs_X_b.append(planes[0])
+            dfs_Y_b.append(planes[1])
+            dfs_X_p.append(planes[2])
+            dfs_Y_p.append(planes[3])
+        except Exception as e:
+            print(f"[ERROR] Failed {exp}: {e}")
+    return dfs_X_b, dfs_Y_b, dfs_X_p, dfs_Y_p
+
+def process_stimulus_folder(stimulus_folder, source='csv'):
+    if source == 'npz':
+        return process_stimulus_folder_npz(stimulus_folder)
     strength = os.path.basename(stimulus_folder)
     files_X_b = validate_and_sort(glob.glob(os.path.join(stimulus_folder, '**/*_sampled_X_b.csv'), recursive=True))
     files_Y_b = validate_and_sort(glob.glob(os.path.join(stimulus_folder, '**/*_sampled_Y_b.csv'), recursive=True), expected=len(files_X_b), label="Y_b")
@@ -28,10 +69,12 @@ def process_stimulus_folder(stimulus_folder):
     for fXb, fYb, fXp, fYp in zip(files_X_b, files_Y_b, files_X_p, files_Y_p):
         exp = os.path.basename(fXb).split('_sampled')[0]
         try:
-            df_X_b = pd.read_csv(fXb).T.iloc[1:]
-            df_Y_b = pd.read_csv(fYb).T.iloc[1:]
-            df_X_p = pd.read_csv(fXp).T.iloc[1:]
-            df_Y_p = pd.read_csv(fYp).T.iloc[1:]
+            with stage('read_recording', file=fXb, bytes=sum(os.path.getsize(f) for f in (fXb, fYb, fXp, fYp))) as info:
+                df_X_b = pd.read_csv(fXb).T.iloc[1:]
+                df_Y_b = pd.read_csv(fYb).T.iloc[1:]
+                df_X_p = pd.read_csv(fXp).T.iloc[1:]
+                df_Y_p = pd.read_csv(fYp).T.iloc[1:]
+                info['rows'] = len(df_X_b)
             if not (len(df_X_b) == len(df_Y_b) == len(df_X_p) == len(df_Y_p)):
                 print(f"[WARNING] Data length mismatch in {exp}, skipping.")
                 continue
@@ -45,49 +88,85 @@ def process_stimulus_folder(stimulus_folder):
             print(f"[ERROR] Failed {exp}: {e}")
     return dfs_X_b, dfs_Y_b, dfs_X_p, dfs_Y_p
 
-def merge_and_reorder(dfs):
+@contextmanager
+def track_memory(stage_name, enabled=True):
+    with stage(stage_name, trace_memory=enabled) as info:
+        yield info
+    if enabled:
+        rss = f", process max RSS {info['max_rss_mb']:.1f} MB" if info['max_rss_mb'] is not None else ''
+        print(f"[MEMORY] {stage_name}: peak {info['peak_traced_mb']:.1f} MB{rss}")
+
+def merge_and_reorder(dfs, dtype=np.float64):
     if not dfs:
         return pd.DataFrame()
-    merged = pd.concat(dfs, ignore_index=True)
-    for col in ['Experiment', 'Stimulus_Strength']:
-        if col in merged.columns:
-            merged = merged[[col] + [c for c in merged.columns if c != col]]
+    meta_cols = ['Experiment', 'Stimulus_Strength']
+    columns = pd.Index([])
+    for df in dfs:
+        columns = columns.union(df.columns.drop(meta_cols, errors='ignore'), sort=False)
+
+    # One preallocated numeric block instead of concatenating and reordering frame copies
+    n_rows = sum(len(df) for df in dfs)
+    block = np.full((n_rows, len(columns)), np.nan, dtype=dtype)
+    row = 0
+    for df in dfs:
+        numeric = df.drop(columns=meta_cols, errors='ignore')
+        block[row:row + len(df), columns.get_indexer(numeric.columns)] = numeric.to_numpy(dtype=dtype)
+        row += len(df)
+    merged = pd.DataFrame(block, columns=columns)
+    for col in reversed(meta_cols):
+        if col in dfs[0].columns:
+            merged.insert(0, col, pd.Categorical(np.concatenate([df[col].to_numpy(dtype=object) for df in dfs])))
     return merged
 
 def edge_cut(df, x_min=100, x_max=1100):
-    df.iloc[:, 2:] = df.iloc[:, 2:].apply(pd.to_numeric, errors='coerce') \
-                                 .applymap(lambda x: x if np.isnan(x) or x_min <= x <= x_max else np.nan)
+    numeric = df.iloc[:, 2:]
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in numeric.dtypes):
+        numeric = numeric.apply(pd.to_numeric, errors='coerce')
+    values = numeric.to_numpy()
+    if values.dtype.kind != 'f':
+        values = values.astype(float)
+    # NaN compares False on both sides and stays NaN
+    df.iloc[:, 2:] = np.where((values >= x_min) & (values <= x_max), values, np.nan)
     return df
 
-def prepare_df(df):
-    numeric = df.iloc[:, 2:].astype(float).dropna(how='all')
-    return pd.concat([df[['Experiment', 'Stimulus_Strength']], numeric], axis=1)
-
-def process_all(parent_dir):
+def process_all(parent_dir, source='csv', dtype=np.float64, report_memory=False):
     folders = glob.glob(os.path.join(parent_dir, '*'))
     all_X_b, all_Y_b, all_X_p, all_Y_p = [], [], [], []
-    for folder in folders:
-        dfs = process_stimulus_folder(folder)
-        all_X_b += dfs[0]
-        all_Y_b += dfs[1]
-        all_X_p += dfs[2]
-        all_Y_p += dfs[3]
-    merged_X_b = prepare_df(edge_cut(merge_and_reorder(all_X_b)))
-    merged_Y_b = prepare_df(merge_and_reorder(all_Y_b))
-    merged_X_p = prepare_df(edge_cut(merge_and_reorder(all_X_p)))
-    merged_Y_p = prepare_df(merge_and_reorder(all_Y_p))
+    with track_memory('load', report_memory) as load_info:
+        for folder in folders:
+            with stage('process_stimulus_folder', file=folder) as info:
+                dfs = process_stimulus_folder(folder, source=source)
+                info['rows'] = sum(len(df) for df in dfs[0])
+            all_X_b += dfs[0]
+            all_Y_b += dfs[1]
+            all_X_p += dfs[2]
+            all_Y_p += dfs[3]
+        load_info['rows'] = sum(len(df) for df in all_X_b)
+    merged = []
+    for label, dfs, cut in (('X_b', all_X_b, True), ('Y_b', all_Y_b, False),
+                            ('X_p', all_X_p, True), ('Y_p', all_Y_p, False)):
+        with track_memory(f'merge {label}', report_memory) as info:
+            df = merge_and_reorder(dfs, dtype=dtype)
+            info['rows'] = len(df)
+            dfs.clear()
+            merged.append(edge_cut(df) if cut and not df.empty else df)
+    merged_X_b, merged_Y_b, merged_X_p, merged_Y_p = merged
     return merged_X_b, merged_Y_b, merged_X_p, merged_Y_p
 
 def main():
     parent_dir = ''
     output_dir = ''
+    source = 'csv'
     os.makedirs(output_dir, exist_ok=True)
-    df_X_b, df_Y_b, df_X_p, df_Y_p = process_all(parent_dir)
+    configure(os.path.join(output_dir, 'instrumentation.jsonl'))
+    with stage('process_all'):
+        df_X_b, df_Y_b, df_X_p, df_Y_p = process_all(parent_dir, source=source)
     df_X_b.to_csv(os.path.join(output_dir, 'filtered_df_X_b.csv'), index=False)
     df_Y_b.to_csv(os.path.join(output_dir, 'filtered_df_Y_b.csv'), index=False)
     df_X_p.to_csv(os.path.join(output_dir, 'filtered_df_X_p.csv'), index=False)
     df_Y_p.to_csv(os.path.join(output_dir, 'filtered_df_Y_p.csv'), index=False)
     print("Data processing complete.")
+    print_summary()
 
 if __name__ == '__main__':
     main()
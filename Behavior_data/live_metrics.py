@@ -0,0 +1,200 @@
+"""
+Online metrics for recordings that are still running.
+LiveMetrics takes palp/backtrunk coordinates one frame at a time (push) and applies the same frame sampling and
+body-length filter as data_loading_processing.process_csv_file and the same x edge cut as data_organizing.edge_cut.
+It keeps running rheotaxis-angle window probabilities, speed statistics and MSD sums with constant work per frame.
+follow_dlc_csv tails a DLC CSV that is still being written and feeds every new row into a LiveMetrics.
+
+    for live in follow_dlc_csv('session_filtered.csv', idle_timeout=60, exposure_time=0.2):
+        print(live.summary())
+"""
+
+import csv
+import time
+import numpy as np
+import pandas as pd
+
+import behavior_metrics as bm
+from data_loading_processing import select_dlc_columns
+
+BODYPARTS = ('palp', 'backtrunk')
+
+class LiveMetrics:
+    def __init__(self, n_individuals, pixel_size=25, rate=5, distance_threshold_lower=100, distance_threshold_upper=500,
+                 edge_cut=(100, 1100), exposure_time=0.2, offset=0.061, bins=((0, np.pi / 2),), time_window_size=60,
+                 max_lag=50):
+        self.n_individuals = n_individuals
+        self.pixel_size = pixel_size
+        self.rate = rate
+        self.distance_threshold_lower = distance_threshold_lower
+        self.distance_threshold_upper = distance_threshold_upper
+        self.edge_cut = edge_cut
+        self.exposure_time = exposure_time
+        self.offset = offset
+        self.bounds = np.asarray(bins, dtype=float).reshape(-1, 2)
+        self.time_window_size = time_window_size
+        self.max_lag = max_lag
+
+        self.rows_seen = 0
+        self.n_frames = 0
+        # Angle probability: per-timepoint probabilities of the current window, finished windows, running mean
+        self.window_sum = np.zeros(len(self.bounds))
+        self.window_valid = 0
+        self.window_probabilities = []
+        self.probability_sum = np.zeros(len(self.bounds))
+        self.probability_count = 0
+        # Speed (Welford running mean and variance) needs the previous centre of mass of every individual
+        self.prev_com = np.full((n_individuals, 2), np.nan)
+        self.speed_n, self.speed_mean, self.speed_m2 = 0, 0.0, 0.0
+        # MSD: ring buffer of the last max_lag positions; slot (n_frames - w) % max_lag holds lag w
+        self.history = np.full((max_lag, n_individuals, 2), np.nan)
+        self.msd_sums = np.zeros(max_lag)
+        self.msd_m2 = np.zeros(max_lag)
+        self.msd_counts = np.zeros(max_lag, dtype=np.int64)
+
+    def push(self, coords):
+        # coords: (individual, bodypart, xy) for one raw DLC row, body parts ordered as BODYPARTS.
+        # Returns False when the row is dropped by the frame sampling.
+        row = self.rows_seen
+        self.rows_seen += 1
+        if row % self.rate != 0:
+            return False
+        coords = self._filter(np.array(coords, dtype=float))
+        self._update_probability(coords)
+        self._update_speed(coords)
+        self._update_msd(coords)
+        self.n_frames += 1
+        return True
+
+    def push_many(self, block):
+        for coords in block:
+            self.push(coords)
+
+    def _filter(self, coords):
+        # Body-length filter of process_csv_file, then the x-range cut of edge_cut on both body parts
+        palp, backtrunk = coords[:, 0], coords[:, 1]
+        distance = np.sqrt(((palp - backtrunk) ** 2).sum(axis=1)) * self.pixel_size
+        body_ok = (distance >= self.distance_threshold_lower) & (distance <= self.distance_threshold_upper)
+        coords = np.where(body_ok[:, None, None] & (coords != 0), coords, np.nan)
+        if self.edge_cut is not None:
+            x = coords[:, :, 0]
+            x[(x < self.edge_cut[0]) | (x > self.edge_cut[1])] = np.nan
+        return coords
+
+    def _update_probability(self, coords):
+        # Same per-timepoint probability and window averaging as behavior_metrics.calculate_probability_bins
+        angle = np.mod(np.arctan2(coords[:, 0, 0] - coords[:, 1, 0], coords[:, 0, 1] - coords[:, 1, 1]) + self.offset,
+                       2 * np.pi)
+        angle = angle[~np.isnan(angle)]
+        if len(angle):
+            in_bin = ((angle >= self.bounds[:, :1]) & (angle <= self.bounds[:, 1:])).sum(axis=1)
+            self.window_sum += in_bin / len(angle)
+            self.window_valid += 1
+            self.probability_sum += in_bin / len(angle)
+            self.probability_count += 1
+        if (self.n_frames + 1) % self.time_window_size == 0:
+            self.window_probabilities.append(self.window_sum / self.window_valid if self.window_valid
+                                             else np.full(len(self.bounds), np.nan))
+            self.window_sum = np.zeros(len(self.bounds))
+            self.window_valid = 0
+
+    def _update_speed(self, coords):
+        # Centre of mass with NaN propagation, as in calculate_kinematics
+        com = coords.mean(axis=1)
+        speed = np.sqrt(((com - self.prev_com) ** 2).sum(axis=1)) / self.exposure_time
+        self.prev_com = com
+        for value in speed[~np.isnan(speed)]:
+            self.speed_n += 1
+            delta = value - self.speed_mean
+            self.speed_mean += delta / self.speed_n
+            self.speed_m2 += delta * (value - self.speed_mean)
+
+    def _update_msd(self, coords):
+        # Centre of mass as in trajectory_center_of_mass (a missing body part counts as 0), so the pooled sums match
+        # behavior_metrics.calculate_msd on the finished recording for every lag up to max_lag
+        com = np.nan_to_num(coords).sum(axis=1) / 2
+        com[com == 0] = np.nan
+        com[np.isnan(com).any(axis=1)] = np.nan
+        slots = (self.n_frames - np.arange(1, self.max_lag + 1)) % self.max_lag
+        d2 = ((self.history[slots] - com) ** 2).sum(axis=2)
+        valid = ~np.isnan(d2)
+        # Pooled with the running sums and M2 like the speed's Welford update, one batch of individuals per lag
+        n = valid.sum(axis=1)
+        batch_sums = np.where(valid, d2, 0.).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            batch_m2 = np.where(valid, (d2 - (batch_sums / n)[:, None]) ** 2, 0.).sum(axis=1)
+        self.msd_sums, self.msd_m2, self.msd_counts = bm.pool_msd_stats(
+            [self.msd_sums, batch_sums], [self.msd_m2, batch_m2], [self.msd_counts, n])
+        self.history[self.n_frames % self.max_lag] = com
+
+    def probability(self):
+        # Finished windows in the layout of calculate_probability_bins, plus the window in progress
+        prob = np.array(self.window_probabilities).T if self.window_probabilities else np.empty((len(self.bounds), 0))
+        table = bm._probability_table(prob, self.bounds)
+        table['Complete'] = True
+        if self.n_frames % self.time_window_size:
+            partial = bm._probability_table((self.window_sum / self.window_valid if self.window_valid
+                                             else np.full(len(self.bounds), np.nan))[:, None], self.bounds)
+            partial['Window'] = len(self.window_probabilities)
+            partial['Complete'] = False
+            table = pd.concat([table, partial], ignore_index=True)
+        return table
+
+    def msd(self):
+        msd, sem = bm._msd_table(self.msd_sums, self.msd_m2, self.msd_counts)
+        return pd.DataFrame({'MSD': msd, 'SEM': sem, 'Count': self.msd_counts},
+                            index=pd.Index(np.arange(1, self.max_lag + 1), name='Lag'))
+
+    def summary(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            running = self.probability_sum / self.probability_count
+        return {
+            'frames': self.n_frames,
+            'rows_seen': self.rows_seen,
+            'probability': dict(zip(map(tuple, self.bounds), running)),
+            'speed_mean': self.speed_mean if self.speed_n else np.nan,
+            'speed_std': np.sqrt(self.speed_m2 / self.speed_n) if self.speed_n else np.nan,
+            'speed_n': self.speed_n,
+            'msd_lag1': self.msd_sums[0] / self.msd_counts[0] if self.msd_counts[0] else np.nan,
+        }
+
+def wait_for_header(file, poll_interval=1.0, timeout=None):
+    started = time.monotonic()
+    while True:
+        try:
+            return select_dlc_columns(file, BODYPARTS, ('x', 'y'))
+        except (OSError, ValueError):
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise
+            time.sleep(poll_interval)
+
+def follow_dlc_csv(file, live=None, poll_interval=1.0, idle_timeout=None, **kwargs):
+    # Generator: yields the LiveMetrics after every batch of new rows and stops once the file has not grown for
+    # idle_timeout seconds (None follows the file forever). A line is only parsed once its newline has been written.
+    selected, individual_ids, header_rows = wait_for_header(file, poll_interval, idle_timeout)
+    columns = [col for col, _, _, _ in selected]
+    target = ([individual_ids.index(ind) for _, ind, _, _ in selected],
+              [BODYPARTS.index(bp) for _, _, bp, _ in selected],
+              [('x', 'y').index(c) for _, _, _, c in selected])
+    live = live if live is not None else LiveMetrics(len(individual_ids), **kwargs)
+
+    with open(file, 'r', encoding='ISO-8859-1', newline='') as f:
+        for _ in range(header_rows):
+            f.readline()
+        pending = ''
+        last_data = time.monotonic()
+        while True:
+            chunk = f.read()
+            if not chunk:
+                if idle_timeout is not None and time.monotonic() - last_data > idle_timeout:
+                    return
+                time.sleep(poll_interval)
+                continue
+            last_data = time.monotonic()
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            coords = np.full((live.n_individuals, len(BODYPARTS), 2), np.nan)
+            for row in csv.reader(line for line in lines if line.strip()):
+                coords[target] = [float(row[col]) if row[col] else np.nan for col in columns]
+                live.push(coords)
+            yield live
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import behavior_metrics as bm
+
+def msd_per_lag(com_x, com_y, max_lag):
+    # The original sliding-window loop: mean and SEM (np.std / sqrt(n)) of all valid squared displacements per lag
+    msd, sem = np.full(max_lag, np.nan), np.full(max_lag, np.nan)
+    for wind in range(1, max_lag + 1):
+        d2 = (com_x[:, wind:] - com_x[:, :-wind]) ** 2 + (com_y[:, wind:] - com_y[:, :-wind]) ** 2
+        d2 = d2[~np.isnan(d2)]
+        if len(d2):
+            msd[wind - 1], sem[wind - 1] = np.mean(d2), np.std(d2) / np.sqrt(len(d2))
+    return msd, sem
+
+def tracks(kind, n_tracks=12, n_frames=1500, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_frames)
+    if kind == 'ballistic':
+        # Nearly constant speed and heading: the squared displacements at one lag hardly vary
+        speed, heading = 10 + 0.01 * rng.normal(size=(n_tracks, 1)), 0.3 + 0.01 * rng.normal(size=(n_tracks, 1))
+        x = 300 + speed * np.cos(heading) * t + rng.normal(0, 0.5, (n_tracks, n_frames))
+        y = 200 + speed * np.sin(heading) * t + rng.normal(0, 0.5, (n_tracks, n_frames))
+    else:
+        x = 500 + rng.normal(0, 3, (n_tracks, n_frames)).cumsum(axis=1)
+        y = 500 + rng.normal(0, 3, (n_tracks, n_frames)).cumsum(axis=1)
+    x[rng.random(x.shape) < 0.05] = np.nan
+    x[0] = np.nan
+    x[1, 3:] = np.nan
+    return x, y
+
+@pytest.mark.parametrize('kind', ['ballistic', 'diffusive'])
+def test_msd_sem_matches_per_lag_loop(kind):
+    x, y = tracks(kind)
+    result = bm.calculate_msd(x, y, max_lag=750)
+    msd, sem = msd_per_lag(x, y, 750)
+    np.testing.assert_allclose(result['MSD'], msd, rtol=1e-10)
+    np.testing.assert_allclose(result['SEM'], sem, rtol=1e-9)
+
+def test_per_track_msd_sem_matches_per_lag_loop():
+    x, y = tracks('ballistic', n_tracks=4)
+    result = bm.calculate_msd(x, y, max_lag=200, per_track=True)
+    for track in range(4):
+        msd, sem = msd_per_lag(x[track:track + 1], y[track:track + 1], 200)
+        np.testing.assert_allclose(result.loc[track, 'MSD'], msd, rtol=1e-10)
+        np.testing.assert_allclose(result.loc[track, 'SEM'], sem, rtol=1e-9)
+
+def test_pool_msd_stats_in_parts_matches_all_tracks():
+    x, y = tracks('ballistic')
+    pooled = bm.pool_msd_stats(*bm.msd_sufficient_stats(x, y, 300))
+    parts = [bm.pool_msd_stats(*bm.msd_sufficient_stats(x[rows], y[rows], 300)) for rows in (slice(0, 5), slice(5, None))]
+    for a, b in zip(pooled, bm.pool_msd_stats(*(np.stack(stats) for stats in zip(*parts)))):
+        np.testing.assert_allclose(a, b, rtol=1e-12)
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+from chunked_metrics import build_coordinate_store, run_chunked, ProbabilityAccumulator, MSDAccumulator, SpeedHistogram
+from test_trajectory_set import write_recordings
+
+def accumulators():
+    return [ProbabilityAccumulator([(0, np.pi / 2), (np.pi / 2, np.pi)], 10), MSDAccumulator(max_lag=20),
+            SpeedHistogram(np.linspace(0, 2000, 21), 0.2)]
+
+def test_run_chunked_counts_existing_data_once(tmp_path):
+    write_recordings(str(tmp_path / 'processed'))
+    store_dir = str(tmp_path / 'store')
+    build_coordinate_store(str(tmp_path / 'processed'), store_dir)
+
+    # Accumulators that already hold one pass over the store, then a second pass serially or with workers
+    serial = run_chunked(store_dir, run_chunked(store_dir, accumulators(), chunk_size=3), chunk_size=3)
+    parallel = run_chunked(store_dir, run_chunked(store_dir, accumulators(), chunk_size=3), chunk_size=3,
+                           n_workers=2)
+    for a, b in zip(serial, parallel):
+        pd.testing.assert_frame_equal(a.result(), b.result())
+
+    # The second pass doubles every count of a single pass
+    single = run_chunked(store_dir, accumulators(), chunk_size=3, n_workers=2)
+    assert (parallel[1].result()['Count'] == 2 * single[1].result()['Count']).all()
@@ -0,0 +1,94 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+import data_loading_processing as dlp
+
+def write_dlc_csv(path, n_individuals=2, n_frames=60, seed=0):
+    # Multi-animal DLC layout: scorer, individuals, bodyparts and coords header rows, then one row per frame
+    rng = np.random.default_rng(seed)
+    columns = [(f'ind{i}', bp, coord) for i in range(n_individuals) for bp in ('palp', 'backtrunk', 'head')
+               for coord in ('x', 'y', 'likelihood')]
+    header = [['scorer'] + ['DLC'] * len(columns)] + [[name] + [c[level] for c in columns]
+                                                      for level, name in enumerate(('individuals', 'bodyparts', 'coords'))]
+    values = rng.uniform(0, 40, (n_frames, len(columns)))
+    rows = [[str(frame)] + [f'{v:.6f}' for v in row] for frame, row in enumerate(values)]
+    with open(path, 'w') as f:
+        f.write('\n'.join(','.join(row) for row in header + rows) + '\n')
+
+def experiment_folder(root, seed=0):
+    # Outputs are named after the input file, so recording names are unique across the subfolders
+    for day, n_individuals in (('day1', 2), ('day2', 3)):
+        os.makedirs(os.path.join(root, day))
+        for i in range(2):
+            write_dlc_csv(os.path.join(root, day, f'{day}_rec{i}_filtered.csv'), n_individuals, seed=seed + i)
+    return root
+
+def count_processed(monkeypatch):
+    processed = []
+    process_csv_file = dlp.process_csv_file
+    def counting(file, *args, **kwargs):
+        processed.append(os.path.basename(os.path.dirname(file)) + '/' + os.path.basename(file))
+        return process_csv_file(file, *args, **kwargs)
+    monkeypatch.setattr(dlp, 'process_csv_file', counting)
+    return processed
+
+def test_manifest_skips_unchanged_files(tmp_path, monkeypatch):
+    folder = experiment_folder(str(tmp_path / 'experiment'))
+    processed = count_processed(monkeypatch)
+
+    assert dlp.process_experiment_folder(folder) == []
+    assert len(processed) == 4
+
+    # Unchanged files are skipped
+    processed.clear()
+    dlp.process_experiment_folder(folder)
+    assert processed == []
+
+    # A changed file and a missing output are processed again, nothing else
+    write_dlc_csv(os.path.join(folder, 'day1', 'day1_rec0_filtered.csv'), 2, n_frames=61)
+    os.remove(glob.glob(os.path.join(folder, 'Processed_Results', '*', 'day1_rec1_filtered_sampled_X_b.csv'))[0])
+    dlp.process_experiment_folder(folder)
+    assert sorted(processed) == ['day1/day1_rec0_filtered.csv', 'day1/day1_rec1_filtered.csv']
+
+    # Other parameters invalidate every entry
+    processed.clear()
+    dlp.process_experiment_folder(folder, rate=2)
+    assert len(processed) == 4
+
+def test_parallel_matches_serial(tmp_path):
+    serial = experiment_folder(str(tmp_path / 'serial'))
+    parallel = experiment_folder(str(tmp_path / 'parallel'))
+    assert dlp.process_experiment_folder(serial, output_format='both') == []
+    assert dlp.process_experiment_folder(parallel, n_workers=2, output_format='both') == []
+
+    outputs = lambda root: sorted(os.path.relpath(path, root) for path in
+                                  glob.glob(os.path.join(root, 'Processed_Results', '*', '*_sampled*')))
+    assert outputs(serial) == outputs(parallel) and len(outputs(serial)) == 4 * 5
+    for name in outputs(serial):
+        if name.endswith('.csv'):
+            pd.testing.assert_frame_equal(pd.read_csv(os.path.join(serial, name), index_col=0),
+                                          pd.read_csv(os.path.join(parallel, name), index_col=0))
+        else:
+            with np.load(os.path.join(serial, name)) as a, np.load(os.path.join(parallel, name)) as b:
+                assert sorted(a.files) == sorted(b.files)
+                for key in a.files:
+                    np.testing.assert_array_equal(a[key], b[key])
+
+def test_dtype_reaches_outputs_and_manifest(tmp_path, monkeypatch):
+    folder = experiment_folder(str(tmp_path / 'experiment'))
+    processed = count_processed(monkeypatch)
+    dlp.process_experiment_folder(folder, output_format='npz')
+    full = {os.path.basename(path): np.load(path)['coords']
+            for path in glob.glob(os.path.join(folder, 'Processed_Results', '*', '*.npz'))}
+
+    # Another dtype invalidates the manifest entries and is written to the recordings
+    processed.clear()
+    assert dlp.process_experiment_folder(folder, output_format='npz', dtype=np.float32) == []
+    assert len(processed) == 4
+    for path in glob.glob(os.path.join(folder, 'Processed_Results', '*', '*.npz')):
+        with np.load(path) as rec:
+            assert rec['coords'].dtype == np.float32
+            assert '"dtype": "float32"' in str(rec['params'])
+            np.testing.assert_allclose(rec['coords'], full[os.path.basename(path)], rtol=1e-6)
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+
+import behavior_metrics as bm
+from data_loading_processing import save_recording
+from data_organizing import process_all
+from trajectory_set import TrajectorySet
+
+def write_recordings(parent_dir):
+    # Two stimulus folders, recordings of different lengths with coordinates on both sides of the x edge cut
+    rng = np.random.default_rng(0)
+    for strength, experiments in (('25', [('exp_a', 3, 80), ('exp_b', 2, 95)]), ('75', [('exp_c', 4, 70)])):
+        folder = os.path.join(parent_dir, strength, 'day1')
+        os.makedirs(folder)
+        for experiment, n_individuals, n_frames in experiments:
+            coords = rng.uniform(0, 1200, (n_individuals, n_frames, 2, 2))
+            coords[rng.random(coords.shape[:2]) < 0.1] = np.nan
+            save_recording(os.path.join(folder, f'{experiment}_sampled.npz'), coords,
+                           [f'ind{i}' for i in range(n_individuals)], np.arange(n_frames), experiment, {})
+
+def test_from_recordings_matches_process_all(tmp_path):
+    write_recordings(str(tmp_path))
+    from_recordings = TrajectorySet.from_recordings(str(tmp_path))
+    from_frames = TrajectorySet.from_frames(*process_all(str(tmp_path), source='npz'))
+    assert len(from_recordings) == len(from_frames)
+    assert np.nanmax(from_recordings.coords[..., 0]) <= 1100 and np.nanmin(from_recordings.coords[..., 0]) >= 100
+
+    recordings_groups, frames_groups = from_recordings.groups(), from_frames.groups()
+    assert set(recordings_groups) == set(frames_groups)
+    for key, rows in recordings_groups.items():
+        a, b = from_recordings.take(rows), from_frames.take(frames_groups[key])
+        np.testing.assert_array_equal(a.coords, b.coords)
+        np.testing.assert_allclose(bm.trajectory_msd(a, max_lag=20).to_numpy(),
+                                   bm.trajectory_msd(b, max_lag=20).to_numpy(), equal_nan=True)
+
+def test_from_recordings_without_edge_cut(tmp_path):
+    write_recordings(str(tmp_path))
+    raw = TrajectorySet.from_recordings(str(tmp_path), edge_cut=None)
+    assert np.nanmax(raw.coords[..., 0]) > 1100 and np.nanmin(raw.coords[..., 0]) < 100
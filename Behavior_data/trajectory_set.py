@@ -0,0 +1,122 @@
+"""
+Array-backed container for palp/backtrunk trajectories.
+Holds one contiguous (track x frame x bodypart x xy) float array plus a separate categorical metadata table,
+with zero-copy views for body parts and time slices and cheap filtering by experiment or stimulus.
+"""
+
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+BODYPARTS = ('palp', 'backtrunk')
+META_COLUMNS = ['Experiment', 'Stimulus_Strength']
+
+class TrajectorySet:
+    def __init__(self, coords, meta, bodyparts=BODYPARTS):
+        if coords.ndim != 4 or coords.shape[2] != len(bodyparts) or coords.shape[3] != 2:
+            raise ValueError(f"coords must have shape (track, frame, {len(bodyparts)}, 2), got {coords.shape}")
+        if len(meta) != coords.shape[0]:
+            raise ValueError(f"meta has {len(meta)} rows for {coords.shape[0]} tracks")
+        self.coords = coords
+        self.meta = meta.reset_index(drop=True)
+        self.bodyparts = tuple(bodyparts)
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def __repr__(self):
+        return f"TrajectorySet(tracks={self.n_tracks}, frames={self.n_frames}, bodyparts={self.bodyparts})"
+
+    @property
+    def n_tracks(self):
+        return self.coords.shape[0]
+
+    @property
+    def n_frames(self):
+        return self.coords.shape[1]
+
+    @classmethod
+    def from_frames(cls, x_b, y_b, x_p, y_p, cat_cols=2, dtype=np.float64):
+        # Same argument order as the tables returned by data_organizing.process_all
+        coords = np.empty((x_b.shape[0], x_b.shape[1] - cat_cols, len(BODYPARTS), 2), dtype=dtype)
+        for df, bodypart, axis in ((x_p, 'palp', 0), (y_p, 'palp', 1), (x_b, 'backtrunk', 0), (y_b, 'backtrunk', 1)):
+            coords[:, :, BODYPARTS.index(bodypart), axis] = df.iloc[:, cat_cols:].to_numpy(dtype=dtype)
+        meta = x_b.iloc[:, :cat_cols].astype('category')
+        return cls(coords, meta)
+
+    @classmethod
+    def from_recordings(cls, parent_dir, dtype=np.float64, edge_cut=(100, 1100)):
+        # Reads the _sampled.npz recordings written by data_loading_processing, one stimulus folder per strength.
+        # edge_cut applies the x-range filter of data_organizing.process_all to both body parts (None keeps every value)
+        recordings = []
+        for folder in sorted(glob.glob(os.path.join(parent_dir, '*'))):
+            strength = os.path.basename(folder)
+            for file in sorted(glob.glob(os.path.join(folder, '**/*_sampled.npz'), recursive=True)):
+                with np.load(file) as rec:
+                    order = [list(rec['bodyparts']).index(bodypart) for bodypart in BODYPARTS]
+                    recordings.append((rec['coords'][:, :, order], str(rec['experiment']), strength))
+        if not recordings:
+            return cls(np.empty((0, 0, len(BODYPARTS), 2), dtype=dtype), pd.DataFrame(columns=META_COLUMNS))
+
+        # Recordings of different length are padded with NaN into one preallocated block
+        n_tracks = sum(coords.shape[0] for coords, _, _ in recordings)
+        n_frames = max(coords.shape[1] for coords, _, _ in recordings)
+        block = np.full((n_tracks, n_frames, len(BODYPARTS), 2), np.nan, dtype=dtype)
+        row = 0
+        for coords, _, _ in recordings:
+            block[row:row + coords.shape[0], :coords.shape[1]] = coords
+            row += coords.shape[0]
+        if edge_cut is not None:
+            x = block[:, :, :, 0]
+            x[(x < edge_cut[0]) | (x > edge_cut[1])] = np.nan
+        meta = pd.DataFrame({
+            'Experiment': np.repeat([exp for _, exp, _ in recordings], [c.shape[0] for c, _, _ in recordings]),
+            'Stimulus_Strength': np.repeat([s for _, _, s in recordings], [c.shape[0] for c, _, _ in recordings]),
+        }).astype('category')
+        return cls(block, meta)
+
+    def bodypart(self, name):
+        return self.coords[:, :, self.bodyparts.index(name)]
+
+    def x(self, name):
+        return self.coords[:, :, self.bodyparts.index(name), 0]
+
+    def y(self, name):
+        return self.coords[:, :, self.bodyparts.index(name), 1]
+
+    def valid_mask(self):
+        return ~np.isnan(self.coords).any(axis=(2, 3))
+
+    def time_slice(self, start=None, stop=None):
+        return TrajectorySet(self.coords[:, start:stop], self.meta, self.bodyparts)
+
+    def take(self, tracks):
+        tracks = np.asarray(tracks)
+        if tracks.dtype == bool:
+            tracks = np.flatnonzero(tracks)
+        # A contiguous selection stays a view of the parent array
+        if len(tracks) and np.array_equal(tracks, np.arange(tracks[0], tracks[0] + len(tracks))):
+            rows = slice(tracks[0], tracks[0] + len(tracks))
+            return TrajectorySet(self.coords[rows], self.meta.iloc[rows], self.bodyparts)
+        return TrajectorySet(self.coords[tracks], self.meta.iloc[tracks], self.bodyparts)
+
+    def select(self, experiment=None, stimulus=None):
+        mask = np.ones(self.n_tracks, dtype=bool)
+        if experiment is not None:
+            mask &= self.meta['Experiment'].isin(np.atleast_1d(experiment)).to_numpy()
+        if stimulus is not None:
+            mask &= self.meta['Stimulus_Strength'].isin(np.atleast_1d(stimulus)).to_numpy()
+        return self.take(mask)
+
+    def groups(self, by=META_COLUMNS):
+        return self.meta.groupby(by, sort=False, observed=True).indices
+
+    def to_frames(self, cat_columns=META_COLUMNS):
+        # Wide X_b, Y_b, X_p, Y_p tables with the metadata columns first, as produced by process_all
+        meta = self.meta[cat_columns].astype(object)
+        frames = []
+        for bodypart, axis in (('backtrunk', 0), ('backtrunk', 1), ('palp', 0), ('palp', 1)):
+            numeric = pd.DataFrame(self.coords[:, :, self.bodyparts.index(bodypart), axis])
+            frames.append(pd.concat([meta, numeric], axis=1))
+        return tuple(frames)
@@ -11,16 +11,31 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 from datetime import date
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from preprocessing import zscore_rawcurves  
 
+from instrumentation import stage, get_records, add_records
+
+BRAIN_REGIONS = {
+    'hindbrain': ['mn', 'amg', 'pmg'],
+    'midbrain': ['pnsrn', 'prrn', 'antrn', 'ant'],
+    'forebrain': ['cor', 'pr'],
+    'pns': ['palp', 'rten', 'aten', 'dcen']
+}
+CELL_TO_REGION = {cell: region for region, cells in BRAIN_REGIONS.items() for cell in cells}
+
+# Default stimulus protocol in seconds, (phase, start, end); end=None runs until the end of the recording
+PHASE_SCHEDULE = (
+    ("before_stimuli", 0, 60),
+    ("first_stimuli", 60, 90),
+    ("after_first_stimuli", 90, 150),
+    ("second_stimuli", 150, 180),
+    ("after_second_stimuli", 180, None),
+)
+
 def group_cells_to_brain_regions(cell_type):
-    group_mapping = {
-        'hindbrain': ['mn', 'amg', 'pmg'],
-        'midbrain': ['pnsrn', 'prrn', 'antrn', 'ant'],
-        'forebrain': ['cor', 'pr'],
-        'pns': ['palp', 'rten', 'aten', 'dcen']
-    }
-    for region, cells in group_mapping.items():
+    for region, cells in BRAIN_REGIONS.items():
         if cell_type in cells:
             return region
     return np.nan
@@ -33,21 +48,37 @@ def prepare_custom_datasets(merged_df):
         subsets[strength] = subset
     return subsets
 
-def split_data_by_phases(df, exposure_time):
+def phase_column_ranges(num_timepoints, exposure_time, schedule=PHASE_SCHEDULE):
+    return dict(_phase_column_ranges(num_timepoints, exposure_time, _schedule_key(schedule)))
+
+def _schedule_key(schedule):
+    # Schedules are given as {phase: (start, end)} or ((phase, start, end), ...); the cache needs a hashable form
+    if isinstance(schedule, dict):
+        return tuple((phase, start, end) for phase, (start, end) in schedule.items())
+    return tuple((phase, start, end) for phase, start, end in schedule)
+
+@lru_cache(maxsize=128)
+def _phase_column_ranges(num_timepoints, exposure_time, schedule):
+    # Half-open [start, end) windows in seconds mapped to column positions (timepoint i is column i + 1);
+    # an end of None runs to the end of the recording
+    timepoints = np.arange(num_timepoints) * exposure_time
+    ranges = {}
+    for phase, start, end in schedule:
+        lo = np.searchsorted(timepoints, start, side='left')
+        hi = num_timepoints if end is None else np.searchsorted(timepoints, end, side='left')
+        ranges[phase] = (int(lo) + 1, int(max(hi, lo)) + 1)
+    return ranges
+
+def split_data_by_phases(df, exposure_time, schedule=PHASE_SCHEDULE):
+    # Every phase frame has the original layout ('cell' followed by the phase's timepoint columns). The float block is
+    # extracted once and each phase wraps a slice of it, so phases are views that share memory: treat them as read-only.
     num_timepoints = df.shape[1] - 3  # Exclude metadata columns
-    timepoints = [i * exposure_time for i in range(num_timepoints)]
-    phases = {
-        "before_stimuli": (0, 60),
-        "first_stimuli": (60, 90),
-        "after_first_stimuli": (90, 150),
-        "second_stimuli": (150, 180),
-        "after_second_stimuli": (180, num_timepoints * exposure_time)
-    }
-    phase_data = {}
-    for phase, (start, end) in phases.items():
-        indices = [i + 1 for i, t in enumerate(timepoints) if start <= t < end]
-        phase_data[phase] = df.iloc[:, [0] + indices] 
-    return phase_data
+    ranges = phase_column_ranges(num_timepoints, exposure_time, schedule)
+    values = df.iloc[:, 1:-2].to_numpy()
+    cells = df.iloc[:, [0]]
+    return {phase: pd.concat([cells, pd.DataFrame(values[:, lo - 1:hi - 1], index=df.index, columns=df.columns[lo:hi],
+                                                  copy=False)], axis=1, copy=False)
+            for phase, (lo, hi) in ranges.items()}
 
 def calculate_weighted_summary(df_loadings, explained_variance, use_abs=True):
     df_loadings_transposed = df_loadings.T
@@ -56,33 +87,55 @@ def calculate_weighted_summary(df_loadings, explained_variance, use_abs=True):
     summary_score = weighted_loadings.abs().sum(axis=1) if use_abs else weighted_loadings.sum(axis=1)
     return summary_score.round(3)
 
-def generate_and_save_summary_data(subsets, output_dir, exposure_time):
+def _phase_summary_task(strength, phase, phase_df):
+    # One independent (strength, phase) job: z-score, PCA fit and per-cell summary scores
+    n_records = len(get_records())
+    with stage('summary_phase', file=f'{strength}/{phase}', rows=len(phase_df)):
+        df_zscored = zscore_rawcurves(phase_df)
+        from pca_analysis import get_PCA_results
+        scores = None
+        if not df_zscored.empty:
+            # Every cell trace is a PCA feature, so loadings and summary scores are keyed by cell type; cells of the
+            # same type share their mean score
+            traces = df_zscored.set_index('cell').T
+            results_pca, df_loadings, explained_variance = get_PCA_results(traces, n_components=5)
+            if results_pca is not None and df_loadings is not None:
+                summary = calculate_weighted_summary(df_loadings, explained_variance, use_abs=True)
+                scores = summary.groupby(level=0, sort=False).mean().to_dict()
+    return scores, get_records()[n_records:]
+
+def region_scores(cells, individual_summary_scores):
+    # Sum of the per-cell-type scores over every cell of a region (NaN scores count as 0, like np.nansum)
+    regions = cells.map(CELL_TO_REGION)
+    scores = cells.map(individual_summary_scores).astype(float)
+    known = regions.notna()
+    return scores[known].fillna(0.).groupby(regions[known], sort=False).sum()
+
+def generate_and_save_summary_data(subsets, output_dir, exposure_time, n_workers=1, schedule=PHASE_SCHEDULE):
     summary_data = {}
     all_cell_types = ['mn', 'amg', 'pmg', 'pnsrn', 'prrn', 'antrn', 'ant', 'cor', 'pr', 'palp', 'rten', 'aten', 'dcen']
-    
-    for strength, subset_df in subsets.items():
-        phase_data = split_data_by_phases(subset_df, exposure_time)
-        for phase, phase_df in phase_data.items():
-            df_zscored = zscore_rawcurves(phase_df)
-           
-            from pca_analysis import get_PCA_results
-            results_pca, df_loadings, explained_variance = get_PCA_results(df_zscored, n_components=5)
-            if results_pca is None or df_loadings is None:
-                print(f"Skipping PCA for phase {phase} due to insufficient data for strength {strength}.")
-                continue
-            individual_summary_scores = calculate_weighted_summary(df_loadings, explained_variance, use_abs=True)
-            individual_summary_scores = individual_summary_scores.to_dict()
-            for cell_type in all_cell_types:
-                if cell_type not in individual_summary_scores:
-                    individual_summary_scores[cell_type] = np.nan
-            phase_df['brain_region'] = phase_df['cell'].apply(group_cells_to_brain_regions)
-            phase_df = phase_df.dropna(subset=['brain_region'])
-            for region in ['hindbrain', 'midbrain', 'forebrain', 'pns']:
-                summary_data.setdefault(region, {}).setdefault(strength, {})[phase] = np.nan
-            for region in phase_df['brain_region'].unique():
-                cells_in_region = phase_df[phase_df['brain_region'] == region]['cell']
-                region_score = np.nansum([individual_summary_scores.get(cell, np.nan) for cell in cells_in_region])
-                summary_data[region][strength][phase] = np.round(region_score, 3)
+
+    tasks = [(strength, phase, phase_df) for strength, subset_df in subsets.items()
+             for phase, phase_df in split_data_by_phases(subset_df, exposure_time, schedule).items()]
+    if n_workers == 1:
+        results = [_phase_summary_task(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_phase_summary_task, *zip(*tasks))) if tasks else []
+
+    for (strength, phase, phase_df), (individual_summary_scores, records) in zip(tasks, results):
+        if n_workers != 1:
+            add_records(records)
+        if individual_summary_scores is None:
+            print(f"Skipping PCA for phase {phase} due to insufficient data for strength {strength}.")
+            continue
+        for cell_type in all_cell_types:
+            if cell_type not in individual_summary_scores:
+                individual_summary_scores[cell_type] = np.nan
+        for region in ['hindbrain', 'midbrain', 'forebrain', 'pns']:
+            summary_data.setdefault(region, {}).setdefault(strength, {})[phase] = np.nan
+        for region, region_score in region_scores(phase_df['cell'], individual_summary_scores).items():
+            summary_data[region][strength][phase] = np.round(region_score, 3)
     return summary_data
 
 def print_cell_type_counts(subsets):
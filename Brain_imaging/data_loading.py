@@ -1,44 +1,98 @@
 """
 Functions to load and merge CSV files containing calcium imaging data.
+The merged table is cached in a binary (pickle) file keyed by the input file list, sizes and mtimes,
+so reruns on an unchanged directory skip all CSV parsing.
 """
 
 import os
 import re
+import hashlib
 import pandas as pd
 from glob import glob
 from datetime import date
+from concurrent.futures import ProcessPoolExecutor
 
-def load_data(directory, pattern="*.csv", verbose=True):
-    files = glob(os.path.join(directory, pattern))
-    if verbose:
-        print(f"Found {len(files)} files in {directory}.")
+from instrumentation import stage, get_records, add_records
+
+def read_imaging_file(file):
+    filename = os.path.basename(file)
+    experiment = filename[:-4]
+    stimuli_part = re.search(r'Gcamp6-(\d+)', filename)
+    stimuli_strength = stimuli_part.group(1) if stimuli_part else 'Unknown'
+
+    with stage('load_file', file=file) as info:
+        df = pd.read_csv(file, index_col=0)
+        info['rows'] = len(df)
+    df['Experiment'] = experiment
+    df['Stimuli_Strength'] = stimuli_strength
+    return df
 
-    merged_df = pd.DataFrame()
+def _read_imaging_worker(file):
+    n_records = len(get_records())
+    try:
+        df, error = read_imaging_file(file), None
+    except Exception as e:
+        df, error = None, e
+    return df, error, get_records()[n_records:]
+
+def files_cache_key(files):
+    digest = hashlib.sha1()
     for file in files:
-        try:
-            filename = os.path.basename(file)
-            experiment = filename[:-4]  
-            stimuli_part = re.search(r'Gcamp6-(\d+)', filename)
-            stimuli_strength = stimuli_part.group(1) if stimuli_part else 'Unknown'
-
-            df = pd.read_csv(file, index_col=0)
-            df['Experiment'] = experiment
-            df['Stimuli_Strength'] = stimuli_strength
-
-            merged_df = pd.concat([merged_df, df], ignore_index=True)
-            if verbose:
-                print(f"Loaded {filename} with {df.shape[0]} rows and {df.shape[1]} columns.")
-        except Exception as e:
-            print(f"Error loading {filename}: {e}")
-            continue
+        stat = os.stat(file)
+        digest.update(f"{os.path.abspath(file)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+def load_data(directory, pattern="*.csv", verbose=True, n_workers=1, use_cache=True, save_csv=True):
+    files = sorted(glob(os.path.join(directory, pattern)))
+    if verbose:
+        print(f"Found {len(files)} files in {directory}.")
 
     output_dir = os.path.join(directory, "Output_new")
     os.makedirs(output_dir, exist_ok=True)
-    csv_output_path = os.path.join(output_dir, "merged_data.csv")
-    merged_df.round(3).to_csv(csv_output_path, index=False)
+    # The pattern is part of the file name, so a rebuild only replaces the stale cache of the same pattern
+    pattern_tag = hashlib.sha1(pattern.encode()).hexdigest()[:8]
+    cache_path = os.path.join(output_dir, f"merged_data_{pattern_tag}_{files_cache_key(files)}.pkl")
+    if use_cache and os.path.exists(cache_path):
+        with stage('load_cache', file=cache_path) as info:
+            merged_df = pd.read_pickle(cache_path)
+            info['rows'] = len(merged_df)
+        if verbose:
+            print(f"Loaded cached merged data from {cache_path}.")
+            print(f"DataFrame Shape: {merged_df.shape}")
+        return merged_df
+
+    if n_workers == 1:
+        results = [_read_imaging_worker(file) for file in files]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_read_imaging_worker, files))
+
+    dfs = []
+    for file, (df, error, records) in zip(files, results):
+        if n_workers != 1:
+            add_records(records)
+        filename = os.path.basename(file)
+        if error is not None:
+            print(f"Error loading {filename}: {error}")
+            continue
+        dfs.append(df)
+        if verbose:
+            print(f"Loaded {filename} with {df.shape[0]} rows and {df.shape[1]} columns.")
+    # A single concatenation instead of growing the merged frame file by file
+    merged_df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+    if use_cache:
+        for stale in glob(os.path.join(output_dir, f"merged_data_{pattern_tag}_*.pkl")):
+            os.remove(stale)
+        merged_df.to_pickle(cache_path)
+    if save_csv:
+        csv_output_path = os.path.join(output_dir, "merged_data.csv")
+        with stage('save_merged_data', rows=len(merged_df)):
+            merged_df.round(3).to_csv(csv_output_path, index=False)
+        if verbose:
+            print(f"Merged data saved to {csv_output_path}.")
 
     if verbose:
-        print(f"Merged data saved to {csv_output_path}.")
         print(f"DataFrame Shape: {merged_df.shape}")
         print(f"Columns: {merged_df.columns.tolist()}")
 
@@ -1,11 +1,20 @@
 """
 Functions to perform PCA on z-scored data and to compute PCA on the entire dataset.
+The entire-dataset PCA can also run chunked: rows are z-scored chunk by chunk and fitted with IncrementalPCA. With a
+merged_df in memory this only bounds IncrementalPCA's working set; for a fit that never holds the full matrix, write
+it once with save_data_memmap and later pass merged_df=None with the same memmap_path.
 """
 
+import os
+import json
+import hashlib
 import pandas as pd
 import numpy as np
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from tslearn.preprocessing import TimeSeriesScalerMeanVariance
+from preprocessing import zscore_array
+
+from instrumentation import stage
 
 def get_PCA_results(df_zscored, n_components=3):
     try:
@@ -15,8 +24,9 @@ def get_PCA_results(df_zscored, n_components=3):
             print(f"Insufficient components for PCA. Required >= 2, got {n_components}.")
             return None, None, None
 
-        pca = PCA(n_components=n_components)
-        results_pca = pca.fit_transform(zscored)
+        with stage('get_PCA_results', rows=zscored.shape[0]):
+            pca = PCA(n_components=n_components)
+            results_pca = pca.fit_transform(zscored)
         loadings = pca.components_
         df_loadings = pd.DataFrame(loadings, columns=df_zscored.columns)
         explained_variance = pca.explained_variance_ratio_ * 100
@@ -29,13 +39,77 @@ def get_PCA_results(df_zscored, n_components=3):
         print(f"Error in PCA computation: {e}")
         return None, None, None
 
-def perform_pca_on_entire_dataset(merged_df, n_components=3):
+def chunk_bounds(n_rows, chunk_size, min_rows=1):
+    # Every partial_fit needs at least n_components rows, so a short last chunk is merged into the previous one
+    if chunk_size < min_rows:
+        raise ValueError(f"chunk_size must be at least {min_rows}, got {chunk_size}")
+    starts = list(range(0, n_rows, chunk_size))
+    if len(starts) > 1 and n_rows - starts[-1] < min_rows:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [n_rows]))
+
+def _data_key(merged_df):
+    # Content hash of the time-series block (column names and per-row hashes)
+    digest = hashlib.sha1(json.dumps([str(col) for col in merged_df.columns[1:-2]]).encode())
+    digest.update(pd.util.hash_pandas_object(merged_df.iloc[:, 1:-2], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def open_data_memmap(path):
+    # Memory-mapped matrix written by save_data_memmap and its column names
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    return np.load(path, mmap_mode='r'), pd.Index(meta['columns'])
+
+def save_data_memmap(merged_df, path, chunk_size=10000, dtype=np.float64):
+    # Writes the time-series block of merged_df to a .npy file that can be memory-mapped later, with a .json sidecar
+    # holding the column names and a content hash; an existing file for the same data is reused without rewriting
+    key = _data_key(merged_df)
+    shape = (len(merged_df), merged_df.shape[1] - 3)
+    if os.path.exists(path) and os.path.exists(path + '.json'):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        data = np.load(path, mmap_mode='r')
+        if meta.get('key') == key and data.shape == shape and data.dtype == np.dtype(dtype):
+            print(f"Reusing memory-mapped data {path}")
+            return data
+    data = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    for lo, hi in chunk_bounds(len(merged_df), chunk_size):
+        data[lo:hi] = merged_df.iloc[lo:hi, 1:-2].to_numpy(dtype=dtype)
+    data.flush()
+    del data
+    with open(path + '.json', 'w') as f:
+        json.dump({'key': key, 'columns': [str(col) for col in merged_df.columns[1:-2]]}, f)
+    return np.load(path, mmap_mode='r')
+
+def perform_incremental_pca(data, n_components=3, chunk_size=10000):
+    # data is any row-sliceable 2D matrix (ndarray, np.memmap, DataFrame block); only one chunk is z-scored at a time
+    pca = IncrementalPCA(n_components=n_components)
+    for lo, hi in chunk_bounds(data.shape[0], chunk_size, n_components):
+        chunk = data.iloc[lo:hi] if isinstance(data, pd.DataFrame) else data[lo:hi]
+        pca.partial_fit(zscore_array(chunk))
+    return pca
+
+def perform_pca_on_entire_dataset(merged_df, n_components=3, chunk_size=None, memmap_path=None):
+    # merged_df=None fits from an existing memmap_path only (chunk_size defaults to 10000 rows)
     try:
-        data_columns = merged_df.columns[1:-2]
-        entire_data = merged_df[data_columns].values
-        zscored_data = TimeSeriesScalerMeanVariance().fit_transform(entire_data)[..., 0]
-        pca = PCA(n_components=n_components)
-        pca.fit(zscored_data)
+        if merged_df is None:
+            data, data_columns = open_data_memmap(memmap_path)
+            chunk_size = chunk_size or 10000
+            n_rows = data.shape[0]
+        else:
+            data_columns = merged_df.columns[1:-2]
+            n_rows = len(merged_df)
+        with stage('perform_pca_on_entire_dataset', rows=n_rows):
+            if chunk_size is None:
+                entire_data = merged_df[data_columns].values
+                zscored_data = TimeSeriesScalerMeanVariance().fit_transform(entire_data)[..., 0]
+                pca = PCA(n_components=n_components)
+                pca.fit(zscored_data)
+            else:
+                if merged_df is not None:
+                    data = merged_df.iloc[:, 1:-2] if memmap_path is None else save_data_memmap(merged_df, memmap_path,
+                                                                                                chunk_size)
+                pca = perform_incremental_pca(data, n_components, chunk_size)
         explained_variance = pca.explained_variance_ratio_ * 100
         for i, variance in enumerate(explained_variance):
             print(f"PC{i+1} explains {variance:.2f}% of the variance.")
@@ -1,5 +1,7 @@
 """
 Functions for generating visualizations.
+Figures can be saved as SVG, PNG (with DPI control) or both; render_batch draws many figures without showing them,
+optionally in parallel worker processes that use the headless Agg backend.
 """
 
 import os
@@ -7,68 +9,113 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 from matplotlib import cm
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+from concurrent.futures import ProcessPoolExecutor
 
-def generate_zscore_clustermaps(df_zscored, sample_id, savepath):
-   try:
+from instrumentation import stage, get_records, add_records
+
+def save_figure(fig, save_dir, name, fmt='svg', dpi=None):
+    # fmt is 'svg', 'png' or a sequence of both; dpi only affects raster output
+    os.makedirs(save_dir, exist_ok=True)
+    for ext in ([fmt] if isinstance(fmt, str) else fmt):
+        fig.savefig(os.path.join(save_dir, f'{name}.{ext}'), dpi=dpi if ext != 'svg' else None)
+
+def generate_zscore_clustermaps(df_zscored, sample_id, savepath, fmt='svg', dpi=None):
+    try:
         scale_cg1 = (len(df_zscored.columns)) / 2
         fig = sns.clustermap(data=df_zscored.T, col_cluster=False, figsize=(15, scale_cg1))
-        save_dir = os.path.join(savepath, 'clustermaps')
-        os.makedirs(save_dir, exist_ok=True)
-        fig.savefig(os.path.join(save_dir, f'clustermap_zscored_{sample_id}.svg'))
+        save_figure(fig, os.path.join(savepath, 'clustermaps'), f'clustermap_zscored_{sample_id}', fmt, dpi)
+        plt.close(fig.figure)
     except Exception as e:
         print(f"Error generating clustermap: {e}")
 
-def generate_pca_loadings_clustermap(df_loadings, sample_id, savepath):
-   try:
+def generate_pca_loadings_clustermap(df_loadings, sample_id, savepath, fmt='svg', dpi=None):
+    try:
         scale_cg1 = (len(df_loadings.columns)) / 2
         fig = sns.clustermap(df_loadings.T, cmap="PiYG", col_cluster=False, figsize=(3, scale_cg1))
-        save_dir = os.path.join(savepath, 'loadings_clustermaps')
-        os.makedirs(save_dir, exist_ok=True)
-        fig.savefig(os.path.join(save_dir, f'clustermap_pca_loadings_{sample_id}.svg'))
+        save_figure(fig, os.path.join(savepath, 'loadings_clustermaps'), f'clustermap_pca_loadings_{sample_id}', fmt, dpi)
+        plt.close(fig.figure)
     except Exception as e:
         print(f"Error generating PCA loadings clustermap: {e}")
 
-def plot_pca_traj3d(results_pca, sample_id, savepath, aten_max_times=[], palp_max_times=[], exposure_time=0.673474):
+def plot_pca_traj3d(results_pca, sample_id, savepath, aten_max_times=[], palp_max_times=[], exposure_time=0.673474,
+                    show=True, fmt='svg', dpi=None):
     if results_pca is None or results_pca.shape[1] < 3:
         print(f"Skipping 3D plot for {sample_id} due to insufficient PCA components.")
         return
     try:
         N = results_pca.shape[0]
-        T = results_pca
+        T = np.asarray(results_pca)
         fig = plt.figure(figsize=(14, 12))
         ax = fig.add_subplot(projection='3d')
         ax.set_aspect('equal')
         cmap = plt.get_cmap('jet')
         norm = plt.Normalize(vmin=0, vmax=N)
-        
-        for i in range(1, N):
-            ax.plot(T[i-1:i+1, 2], T[i-1:i+1, 0], T[i-1:i+1, 1], color=cmap(norm(i)))
-            if i == int(61 / exposure_time):
-                ax.scatter(T[i, 2], T[i, 0], T[i, 1], color='green', s=50, marker='o', label='Start Stimuli')
-            elif i == int((61 + 30) / exposure_time):
-                ax.scatter(T[i, 2], T[i, 0], T[i, 1], color='red', s=50, marker='x', label='End Stimuli')
-        
+
+        # One collection for the whole trajectory, segment i (from point i-1 to i) coloured by i
+        points = T[:, [2, 0, 1]]
+        segments = np.stack([points[:-1], points[1:]], axis=1)
+        ax.add_collection3d(Line3DCollection(segments, colors=cmap(norm(np.arange(1, N)))))
+        start_idx, end_idx = int(61 / exposure_time), int((61 + 30) / exposure_time)
+        if 1 <= start_idx < N:
+            ax.scatter(T[start_idx, 2], T[start_idx, 0], T[start_idx, 1], color='green', s=50, marker='o', label='Start Stimuli')
+        if 1 <= end_idx < N and end_idx != start_idx:
+            ax.scatter(T[end_idx, 2], T[end_idx, 0], T[end_idx, 1], color='red', s=50, marker='x', label='End Stimuli')
+
         def plot_max_transients(transient_times, color, label):
             for time in transient_times:
                 time_idx = int(float(time))
                 if 2 <= time_idx < len(T):
                     ax.scatter(T[time_idx, 2], T[time_idx, 0], T[time_idx, 1], color=color, s=100, marker='*', label=label if time==transient_times[0] else "")
-        
+
         plot_max_transients(aten_max_times, 'orange', 'Aten max transient')
         plot_max_transients(palp_max_times, 'cyan', 'Palp max transient')
-        
+
         handles, labels = ax.get_legend_handles_labels()
         unique_labels = dict(zip(labels, handles))
         ax.legend(unique_labels.values(), unique_labels.keys())
-        
+
         ax.set_xlim(T[:, 2].min()-2, T[:, 2].max()+2)
         ax.set_ylim(T[:, 0].min()-2, T[:, 0].max()+2)
         ax.set_zlim(T[:, 1].min()-2, T[:, 1].max()+2)
         ax.view_init(elev=30., azim=40.)
-        
-        save_dir = os.path.join(savepath, 'pca3dplots_with_stims')
-        os.makedirs(save_dir, exist_ok=True)
-        fig.savefig(os.path.join(save_dir, f'plot3d_{sample_id}.svg'))
-        plt.show()
+
+        save_figure(fig, os.path.join(savepath, 'pca3dplots_with_stims'), f'plot3d_{sample_id}', fmt, dpi)
+        if show:
+            plt.show()
+        plt.close(fig)
     except Exception as e:
         print(f"Error plotting 3D trajectory: {e}")
+
+def _init_render_worker():
+    # Worker processes render headless; the caller's backend is never touched
+    plt.switch_backend('Agg')
+
+def _render_task(func, args, kwargs):
+    # Runs one plotting job and returns the instrumentation records it produced
+    n_records = len(get_records())
+    name = args[1] if len(args) > 1 else None
+    with stage(func.__name__, file=str(name) if name is not None else None):
+        func(*args, **kwargs)
+    return get_records()[n_records:]
+
+def render_batch(jobs, n_workers=1):
+    # jobs are (function, args, kwargs) tuples with one of the plotting functions above, e.g.
+    # (plot_pca_traj3d, (results_pca, sample_id, savepath), {'fmt': 'png', 'dpi': 150})
+    jobs = [(func, tuple(args), dict(kwargs, show=False) if func is plot_pca_traj3d else dict(kwargs))
+            for func, args, kwargs in jobs]
+    if n_workers == 1:
+        # In-process: keep the current backend (switching would close the user's open figures); interactive mode is
+        # off so no window opens, and every plotting function saves and closes its own figure
+        with plt.ioff():
+            for job in jobs:
+                _render_task(*job)
+        return
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_render_worker) as executor:
+        for records in executor.map(_render_task, *zip(*jobs)) if jobs else []:
+            add_records(records)
+
+def render_pca_traj3d_batch(samples, savepath, n_workers=1, fmt='png', dpi=150, **kwargs):
+    # samples maps sample_id -> results_pca; kwargs are passed to every plot_pca_traj3d call
+    render_batch([(plot_pca_traj3d, (results_pca, sample_id, savepath), dict(kwargs, fmt=fmt, dpi=dpi))
+                  for sample_id, results_pca in samples.items()], n_workers)
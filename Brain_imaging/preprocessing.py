@@ -5,15 +5,26 @@ Functios for preprocessing and z-score normalization of raw calcium imaging time
 
 import numpy as np
 import pandas as pd
-from tslearn.preprocessing import TimeSeriesScalerMeanVariance
+
+from instrumentation import stage
+
+def zscore_array(temporal):
+    # Per-row (per time series) z-score with the same arithmetic as tslearn's TimeSeriesScalerMeanVariance,
+    # so the results are bit-identical without building the (n_ts, sz, 1) dataset copy
+    temporal = np.asarray(temporal, dtype=float)
+    mean = np.nanmean(temporal, axis=1, keepdims=True)
+    std = np.nanstd(temporal, axis=1, keepdims=True)
+    std[std == 0.] = 1.
+    return (temporal - mean) * 1. / std + 0.
 
 def zscore_rawcurves(sample_df):
-   try:
-        # Exclude metadata columns; assume first 3 columns are metadata: 'cell', 'Experiment', 'Stimuli_Strength'
-        temporal = sample_df.iloc[:, 3:].values.astype(float)
-        zscored = TimeSeriesScalerMeanVariance().fit_transform(temporal)[..., 0]
-        df_zscored = pd.DataFrame(zscored, index=sample_df.index, columns=sample_df.columns[3:])
-        df_zscored.insert(0, 'cell', sample_df['cell'])
+    try:
+        with stage('zscore_rawcurves', rows=len(sample_df)):
+            # Exclude metadata columns; assume first 3 columns are metadata: 'cell', 'Experiment', 'Stimuli_Strength'
+            temporal = sample_df.iloc[:, 3:].values.astype(float)
+            zscored = zscore_array(temporal)
+            df_zscored = pd.DataFrame(zscored, index=sample_df.index, columns=sample_df.columns[3:])
+            df_zscored.insert(0, 'cell', sample_df['cell'])
         return df_zscored
     except Exception as e:
         print(f"Error in z-score normalization: {e}")
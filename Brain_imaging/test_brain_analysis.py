@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+import brain_analysis as ba
+
+def merged_frame(n_timepoints=400, seed=0):
+    # Layout of data_loading.load_data: cell, one column per timepoint, Experiment, Stimuli_Strength
+    rng = np.random.default_rng(seed)
+    cells = ['mn', 'amg', 'pnsrn', 'prrn', 'cor', 'palp', 'aten', 'mn', 'dcen', 'unknown']
+    frames = []
+    for strength in ('75', '150'):
+        traces = rng.normal(size=(len(cells), n_timepoints)).cumsum(axis=1)
+        df = pd.DataFrame(traces, columns=[str(i) for i in range(n_timepoints)])
+        df.insert(0, 'cell', cells)
+        df['Experiment'], df['Stimuli_Strength'] = f'exp_{strength}', strength
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+def test_region_scores_matches_per_cell_sum():
+    cells = pd.Series(['mn', 'amg', 'mn', 'cor', 'palp', 'unknown'])
+    scores = {'mn': 1.5, 'amg': np.nan, 'cor': 2.0, 'palp': 0.25}
+    result = ba.region_scores(cells, scores)
+    for region, value in result.items():
+        in_region = [cell for cell in cells if ba.CELL_TO_REGION.get(cell) == region]
+        assert value == np.nansum([scores.get(cell, np.nan) for cell in in_region])
+    assert set(result.index) == {'hindbrain', 'forebrain', 'pns'}
+
+def test_summary_parallel_matches_serial(tmp_path):
+    subsets = ba.prepare_custom_datasets(merged_frame())
+    serial = ba.generate_and_save_summary_data(subsets, str(tmp_path), exposure_time=0.673474)
+    parallel = ba.generate_and_save_summary_data(subsets, str(tmp_path), exposure_time=0.673474, n_workers=2)
+    values = [serial[region][strength][phase] for region in serial for strength in serial[region]
+              for phase in serial[region][strength]]
+    assert serial and np.isfinite(values).sum() > 0
+    assert pd.DataFrame(serial).equals(pd.DataFrame(parallel))
+
+def test_split_data_by_phases_views_with_original_layout():
+    df = merged_frame(n_timepoints=300)
+    phases = ba.split_data_by_phases(df, exposure_time=0.673474)
+    for phase, (lo, hi) in ba.phase_column_ranges(300, 0.673474).items():
+        expected = df.iloc[:, np.r_[0, lo:hi]]
+        pd.testing.assert_frame_equal(phases[phase], expected)
+    # The timepoint columns of every phase are slices of one float array
+    def root(array):
+        while array.base is not None:
+            array = array.base
+        return array
+    roots = {id(root(frame[frame.columns[1]].to_numpy())) for frame in phases.values() if frame.shape[1] > 1}
+    assert len(roots) == 1
@@ -0,0 +1,30 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+from data_loading import load_data
+
+def write_imaging_csv(path, n_cells=4, n_timepoints=20, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.normal(size=(n_cells, n_timepoints)), columns=[str(i) for i in range(n_timepoints)])
+    df.insert(0, 'cell', ['mn', 'amg', 'cor', 'palp'][:n_cells])
+    df.to_csv(path)
+
+def test_rebuild_keeps_other_patterns_caches(tmp_path):
+    write_imaging_csv(tmp_path / 'Gcamp6-75_a.csv', seed=0)
+    write_imaging_csv(tmp_path / 'Gcamp6-150_b.csv', seed=1)
+    caches = lambda: sorted(glob.glob(str(tmp_path / 'Output_new' / 'merged_data_*.pkl')))
+
+    first = load_data(str(tmp_path), pattern='*75_*.csv', verbose=False, save_csv=False)
+    load_data(str(tmp_path), pattern='*150_*.csv', verbose=False, save_csv=False)
+    assert len(caches()) == 2
+
+    # Changing a file of the 150 set rebuilds its cache only; the 75 cache is still used
+    write_imaging_csv(tmp_path / 'Gcamp6-150_b.csv', seed=2)
+    os.utime(tmp_path / 'Gcamp6-150_b.csv', ns=(1, 1))
+    load_data(str(tmp_path), pattern='*150_*.csv', verbose=False, save_csv=False)
+    assert len(caches()) == 2
+    cached = load_data(str(tmp_path), pattern='*75_*.csv', verbose=False, save_csv=False)
+    pd.testing.assert_frame_equal(cached, first)
+    assert len(caches()) == 2
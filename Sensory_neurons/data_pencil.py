@@ -2,52 +2,104 @@ import os
 import pandas as pd
 import numpy as np
 from tslearn.preprocessing import TimeSeriesScalerMeanVariance
-from statsmodels.tsa.seasonal import seasonal_decompose
+from scipy.ndimage import correlate1d
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from instrumentation import stage, instrumented
+
+# np.trapz was renamed to np.trapezoid in NumPy 2.0 and later removed
+_trapezoid = np.trapezoid if hasattr(np, 'trapezoid') else np.trapz
 
 def read_and_prepare(file):
+    with stage('read_and_prepare', file=file) as info:
+        long_df = _read_and_prepare(file)
+        info['rows'] = len(long_df)
+    return long_df
+
+def parse_mean_column(values):
+    # Cells hold one number or several tab-separated comma-decimal numbers ('1.234,5\t1.240,0'); sample k of row
+    # i belongs to timepoint i + k. Returns (timepoint, signal) arrays in row order, empty cells read as 0.
+    values = values.reset_index(drop=True)
+    if values.dtype != object:
+        is_str = np.zeros(len(values), dtype=bool)
+    elif pd.api.types.infer_dtype(values, skipna=True) == 'string':
+        is_str = values.notna().to_numpy()
+    else:
+        is_str = values.map(type).eq(str).to_numpy()
+    strings = values[is_str]
+    counts = np.ones(len(values), dtype=np.int64)
+
+    signal = np.empty(0)
+    if is_str.any():
+        # All strings are joined once with NUL between rows: the tab count of every row comes from the byte buffer
+        # and one split yields every sample (thousands separators go before the decimal comma becomes a point)
+        joined = '\0'.join(strings)
+        codes = np.frombuffer(joined.encode(), dtype=np.uint8)
+        tabs_before = np.concatenate([[0], np.cumsum(codes == 9)])
+        tabs_at_row_end = tabs_before[np.append(np.flatnonzero(codes == 0), len(codes))]
+        counts[is_str] = np.diff(tabs_at_row_end, prepend=0) + 1
+        tokens = joined.replace('\0', '\t').replace('.', '').replace(',', '.').split('\t')
+        signal = np.array(tokens, dtype=object).astype(float)
+
+    rows = np.repeat(np.arange(len(values)), counts)
+    sub_idx = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    from_str = np.repeat(is_str, counts)
+    out = np.empty(len(rows))
+    out[from_str] = signal
+    out[~from_str] = pd.to_numeric(values[~is_str]).fillna(0.).to_numpy(dtype=float)
+    return rows + sub_idx, out
+
+def _read_and_prepare(file):
     df = pd.read_csv(file)
     df.columns = df.columns.str.strip()
     filename = os.path.basename(file)
-    for col in df.columns:
-        if 'Mean' in col:
-            df[col] = df[col].apply(
-                lambda x: [float(y.replace('.', '').replace(',', '.')) for y in x.split('\t')]
-                if isinstance(x, str) else ([float(x)] if not pd.isna(x) else [0.0])
-            )
-            df[col] = df[col].apply(lambda x: x[0] if len(x) == 1 else x)
-    reshaped_data = []
-    for col in df.columns:
-        if 'Mean' in col:
-            cell_name = col.split('(')[1].split(')')[0]
-            for idx, value in enumerate(df[col]):
-                if isinstance(value, list):
-                    for sub_idx, sub_value in enumerate(value):
-                        reshaped_data.append({
-                            'Experiment': filename,
-                            'Cell': cell_name,
-                            'Timepoint': idx + sub_idx,
-                            'Signal': sub_value
-                        })
-                else:
-                    reshaped_data.append({
-                        'Experiment': filename,
-                        'Cell': cell_name,
-                        'Timepoint': idx,
-                        'Signal': value
-                    })
-    return pd.DataFrame(reshaped_data)
-
-def subtract_background(non_bg_data, bg_data):
-    result = []
-    for exp in non_bg_data['Experiment'].unique():
-        exp_data = non_bg_data[non_bg_data['Experiment'] == exp].copy()
-        exp_bg = bg_data[bg_data['Experiment'] == exp]
-        if not exp_bg.empty:
-            bg_mean = exp_bg.groupby('Timepoint')['Signal'].mean()
-            exp_data['Signal'] = exp_data.apply(lambda row: row['Signal'] - bg_mean[row['Timepoint']], axis=1)
-        result.append(exp_data)
-    return pd.concat(result, ignore_index=True)
+    mean_cols = [col for col in df.columns if 'Mean' in col]
+    cell_names = [col.split('(')[1].split(')')[0] for col in mean_cols]
+    parsed = [parse_mean_column(df[col]) for col in mean_cols]
+    lengths = [len(signal) for _, signal in parsed]
+    cell_categories = list(dict.fromkeys(cell_names))
+    cell_codes = np.repeat(np.array([cell_categories.index(name) for name in cell_names], dtype=np.int64), lengths)
+    return pd.DataFrame({
+        'Experiment': pd.Categorical.from_codes(np.zeros(sum(lengths), dtype=np.int8), [filename]),
+        'Cell': pd.Categorical.from_codes(cell_codes, cell_categories),
+        'Timepoint': np.concatenate([timepoint for timepoint, _ in parsed] or [np.empty(0, dtype=np.int64)]),
+        'Signal': np.concatenate([signal for _, signal in parsed] or [np.empty(0)]),
+    })
+
+def background_statistic(bg_data, statistic='mean', proportiontocut=0.1):
+    # Per (Experiment, Timepoint) background level; 'trimmed_mean' drops int(n * proportiontocut) samples at each end
+    # of every group, like scipy.stats.trim_mean
+    keys = ['Experiment', 'Timepoint']
+    bg_data = bg_data.dropna(subset=['Signal'])
+    if statistic in ('mean', 'median'):
+        return bg_data.groupby(keys, observed=True)['Signal'].agg(statistic)
+    if statistic == 'trimmed_mean':
+        bg_sorted = bg_data.sort_values(keys + ['Signal'])
+        grouped = bg_sorted.groupby(keys, observed=True, sort=False)['Signal']
+        rank, size = grouped.cumcount(), grouped.transform('size')
+        cut = (size * proportiontocut).astype(int)
+        kept = bg_sorted[(rank >= cut) & (rank < size - cut)]
+        return kept.groupby(keys, observed=True)['Signal'].mean()
+    raise ValueError(f"Unknown background statistic '{statistic}', expected 'mean', 'median' or 'trimmed_mean'")
+
+@instrumented()
+def subtract_background(non_bg_data, bg_data, statistic='mean', proportiontocut=0.1):
+    # Rows come back grouped by experiment in order of first appearance. Experiments without any background rows are
+    # left as is; within an experiment that has background, a timepoint whose background is all NaN or missing gives
+    # NaN (the per-row version gave NaN and raised KeyError respectively)
+    background = background_statistic(bg_data, statistic, proportiontocut).rename('Background')
+    codes = pd.factorize(non_bg_data['Experiment'])[0]
+    order = np.argsort(codes, kind='stable')
+    result = non_bg_data.iloc[order[codes[order] >= 0]].reset_index(drop=True)
+    experiments = result['Experiment'].astype(object)
+    keys = pd.MultiIndex.from_arrays([experiments, result['Timepoint']])
+    background.index = background.index.set_levels(background.index.levels[0].astype(object), level=0)
+    has_background = experiments.isin(pd.unique(bg_data['Experiment'].astype(object))).to_numpy()
+    result['Signal'] = result['Signal'] - np.where(has_background, background.reindex(keys).to_numpy(), 0.)
+    return result
 
+@instrumented()
 def zscore_normalize(data, categorical_columns):
     numeric = data.drop(columns=categorical_columns)
     temporal = np.vstack(numeric.values)
@@ -56,22 +108,275 @@ def zscore_normalize(data, categorical_columns):
     return pd.concat([data[categorical_columns].reset_index(drop=True),
                       df_zscored.reset_index(drop=True)], axis=1)
 
-def decompose_data_rows(df, model='additive', freq=50):
-    trends = []
-    for idx, row in df.iterrows():
-        signal = row.iloc[4:].dropna().values
-        signal = signal[signal != 0]
-        if len(signal) >= 2 * freq:
-            decomp = seasonal_decompose(signal, model=model, period=freq)
-            trend = decomp.trend[~np.isnan(decomp.trend)]
-            padded = list(trend) + [0] * (len(row.iloc[4:]) - len(trend))
-            trends.append(padded)
-        else:
-            trends.append([np.nan] * len(row.iloc[4:]))
+def trend_filter(values, freq=50, model='additive'):
+    # Trend component of statsmodels' seasonal_decompose for every row of a (cells x time) matrix at once: NaNs and
+    # zeros are dropped (valid samples compacted to the left), the centred moving average is applied and the trend is
+    # left-aligned and zero-padded; rows with fewer than 2 * freq samples are NaN
+    values = np.asarray(values, dtype=float)
+    n_rows, n_cols = values.shape
+    valid = ~np.isnan(values) & (values != 0)
+    lengths = valid.sum(axis=1)
+    order = np.argsort(~valid, axis=1, kind='stable')
+    compact = np.where(np.arange(n_cols) < lengths[:, None], np.take_along_axis(values, order, axis=1), 0.)
+    decomposed = lengths >= 2 * freq
+    if model.startswith('m') and (compact[decomposed] < 0).any():
+        raise ValueError("Multiplicative seasonality is not appropriate for zero and negative values")
+
+    filt = np.array([.5] + [1.] * (freq - 1) + [.5]) / freq if freq % 2 == 0 else np.repeat(1. / freq, freq)
+    trend = np.zeros((n_rows, n_cols))
+    n_valid = n_cols - len(filt) + 1
+    if n_valid > 0:
+        half = len(filt) // 2
+        trend[:, :n_valid] = correlate1d(compact, filt, axis=1, mode='constant')[:, half:half + n_valid]
+        trend[np.arange(n_cols) >= (lengths - len(filt) + 1)[:, None]] = 0.
+    trend[~decomposed] = np.nan
+    return trend
+
+@instrumented()
+def decompose_data_rows(df, model='additive', freq=50, n_workers=1, chunk_rows=5000):
+    values = df.iloc[:, 4:].to_numpy(dtype=float)
+    if n_workers == 1 or len(values) <= chunk_rows:
+        trends = trend_filter(values, freq, model)
+    else:
+        chunks = [values[lo:lo + chunk_rows] for lo in range(0, len(values), chunk_rows)]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            trends = np.vstack(list(executor.map(trend_filter, chunks, repeat(freq), repeat(model))))
     df_trend = pd.DataFrame(trends, columns=df.columns[4:])
     return pd.concat([df.iloc[:, :4].reset_index(drop=True), df_trend.reset_index(drop=True)], axis=1)
 
 def calculate_auc(signal, timepoints, start_time, end_time):
     mask = (timepoints >= start_time) & (timepoints <= end_time)
-    auc = np.trapz(signal[mask], timepoints[mask])
+    auc = _trapezoid(signal[mask], timepoints[mask])
     return auc
+
+class AUCIndex:
+    # Cumulative trapezoid integrals of a whole (cells x time) matrix, computed once; any batch of (start, end) windows
+    # is then answered for every cell with two lookups per window. A window touching a NaN sample gives NaN, as with
+    # np.trapz. With interpolate=True the window edges are interpolated linearly between samples; with
+    # interpolate=False only the samples inside [start, end] are integrated, exactly like calculate_auc.
+    def __init__(self, values, timepoints, meta=None):
+        self.values = np.asarray(values, dtype=float)
+        self.timepoints = np.asarray(timepoints, dtype=float)
+        if self.values.ndim != 2 or self.values.shape[1] != len(self.timepoints):
+            raise ValueError(f"values must have shape (cells, {len(self.timepoints)}), got {self.values.shape}")
+        if np.any(np.diff(self.timepoints) <= 0):
+            raise ValueError("timepoints must be strictly increasing")
+        self.meta = meta.reset_index(drop=True) if meta is not None else None
+        segments = np.diff(self.timepoints) * (self.values[:, 1:] + self.values[:, :-1]) / 2
+        nan_segments = np.isnan(segments)
+        zero = np.zeros((len(self.values), 1))
+        self.cumulative = np.hstack([zero, np.cumsum(np.where(nan_segments, 0., segments), axis=1)])
+        self.nan_count = np.hstack([zero, np.cumsum(nan_segments, axis=1)])
+
+    @classmethod
+    def from_frame(cls, df, n_meta=4, exposure_time=1.0):
+        # Wide table as returned by zscore_normalize / decompose_data_rows: metadata first, one column per timepoint
+        timepoints = pd.to_numeric(df.columns[n_meta:]).to_numpy(dtype=float) * exposure_time
+        return cls(df.iloc[:, n_meta:].to_numpy(dtype=float), timepoints, df.iloc[:, :n_meta])
+
+    def _segment(self, x, side):
+        return np.clip(np.searchsorted(self.timepoints, x, side=side) - 1, 0, len(self.timepoints) - 2)
+
+    def _area_to(self, x):
+        # Integral from the first timepoint to x (cells x windows); NaN segments count as 0 here and are flagged
+        # separately from nan_count
+        t, v = self.timepoints, self.values
+        i = self._segment(x, 'right')
+        v_x = v[:, i] + (v[:, i + 1] - v[:, i]) * (x - t[i]) / (t[i + 1] - t[i])
+        partial = (x - t[i]) * (v[:, i] + v_x) / 2
+        return self.cumulative[:, i] + np.where(np.isnan(partial), 0., partial)
+
+    def query(self, starts, ends, interpolate=True):
+        starts, ends = np.atleast_1d(np.asarray(starts, dtype=float)), np.atleast_1d(np.asarray(ends, dtype=float))
+        t = self.timepoints
+        if len(t) < 2:
+            return np.zeros((len(self.values), len(starts)))
+        if interpolate:
+            lo = np.clip(starts, t[0], t[-1])
+            hi = np.maximum(np.clip(ends, t[0], t[-1]), lo)
+            auc = self._area_to(hi) - self._area_to(lo)
+            # Segments from the one containing lo to the one ending at or after hi
+            n_nan = self.nan_count[:, self._segment(hi, 'left') + 1] - self.nan_count[:, self._segment(lo, 'right')]
+            n_nan = np.where(hi > lo, n_nan, 0)
+        else:
+            lo = np.searchsorted(t, starts, side='left')
+            hi = np.minimum(np.maximum(np.searchsorted(t, ends, side='right') - 1, lo), len(t) - 1)
+            lo = np.minimum(lo, hi)
+            auc = self.cumulative[:, hi] - self.cumulative[:, lo]
+            n_nan = self.nan_count[:, hi] - self.nan_count[:, lo]
+        return np.where(n_nan > 0, np.nan, auc)
+
+    def table(self, windows, interpolate=True):
+        # windows: {name: (start, end)} or a list of (start, end); returns the metadata columns plus one AUC column
+        # per window, one row per cell
+        if not isinstance(windows, dict):
+            windows = {f'{start}-{end}': (start, end) for start, end in windows}
+        starts, ends = zip(*windows.values()) if windows else ((), ())
+        auc = pd.DataFrame(self.query(starts, ends, interpolate), columns=list(windows))
+        return auc if self.meta is None else pd.concat([self.meta, auc], axis=1)
+
+class RaggedTraces:
+    # Traces of different lengths in one flat buffer: trace i is values[offsets[i]:offsets[i + 1]], sampled at
+    # timepoints 0, 1, ..., length - 1, with one metadata row per trace. Z-scoring, trend filtering and AUC work on the
+    # whole buffer at once, so traces are never padded to a common length; to_wide() gives the wide DataFrame used by
+    # zscore_normalize / decompose_data_rows / AUCIndex.from_frame.
+    def __init__(self, values, offsets, meta=None, columns=None):
+        self.values = np.asarray(values, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if self.offsets.ndim != 1 or len(self.offsets) == 0 or self.offsets[0] != 0 or \
+                self.offsets[-1] != len(self.values) or np.any(np.diff(self.offsets) < 0):
+            raise ValueError("offsets must start at 0, be non-decreasing and end at len(values)")
+        self.meta = meta.reset_index(drop=True) if meta is not None else pd.DataFrame(index=range(len(self)))
+        if len(self.meta) != len(self):
+            raise ValueError(f"meta has {len(self.meta)} rows for {len(self)} traces")
+        # Wide column labels for positions 0, 1, ...; defaults to the position itself
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def trace(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def _positions(self):
+        # Position of every sample inside its own trace
+        return np.arange(len(self.values)) - np.repeat(self.offsets[:-1], self.lengths)
+
+    def _trace_index(self):
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def _segment_sums(self, x):
+        # Per-trace sums of a flat array aligned with values; empty traces (anywhere in the buffer) sum to 0
+        return np.bincount(self._trace_index(), weights=x, minlength=len(self))
+
+    def with_values(self, values):
+        return RaggedTraces(values, self.offsets, self.meta, self.columns)
+
+    @classmethod
+    def from_long(cls, long_df, keys=('Experiment', 'Cell'), time='Timepoint', value='Signal'):
+        # Long table as returned by read_and_prepare / subtract_background: one trace per keys group (in order of first
+        # appearance), as long as its last timepoint. Repeated timepoints are averaged and missing ones are NaN, as
+        # with pivot_table.
+        keys = list(keys)
+        codes, uniques = pd.MultiIndex.from_frame(long_df[keys]).factorize()
+        _, first = np.unique(codes, return_index=True)
+        timepoints = long_df[time].to_numpy(dtype=np.int64)
+        signal = long_df[value].to_numpy(dtype=float)
+        lengths = np.zeros(len(uniques), dtype=np.int64)
+        np.maximum.at(lengths, codes, timepoints + 1)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        flat = offsets[codes] + timepoints
+        valid = ~np.isnan(signal)
+        total = np.bincount(flat[valid], weights=signal[valid], minlength=offsets[-1])
+        count = np.bincount(flat[valid], minlength=offsets[-1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(count > 0, total / count, np.nan)
+        return cls(values, offsets, long_df[keys].iloc[first])
+
+    @classmethod
+    def from_frame(cls, df, n_meta=4):
+        # Wide table: metadata first, one column per timepoint; trailing NaNs of each row are dropped
+        data = df.iloc[:, n_meta:].to_numpy(dtype=float)
+        present = ~np.isnan(data)
+        lengths = np.where(present.any(axis=1), data.shape[1] - np.argmax(present[:, ::-1], axis=1), 0)
+        keep = np.arange(data.shape[1]) < lengths[:, None]
+        return cls(data[keep], np.concatenate([[0], np.cumsum(lengths)]), df.iloc[:, :n_meta], df.columns[n_meta:])
+
+    def to_wide(self, fill_value=np.nan):
+        n_cols = int(self.lengths.max()) if len(self) else 0
+        wide = np.full((len(self), n_cols), fill_value, dtype=float)
+        wide[self._trace_index(), self._positions()] = self.values
+        columns = self.columns[:n_cols] if self.columns is not None and len(self.columns) >= n_cols else range(n_cols)
+        return pd.concat([self.meta, pd.DataFrame(wide, columns=columns)], axis=1)
+
+    def zscore(self):
+        # Per-trace mean and standard deviation over the non-NaN samples (NaNs stay NaN, constant traces become 0),
+        # like TimeSeriesScalerMeanVariance in zscore_normalize
+        valid = ~np.isnan(self.values)
+        x = np.where(valid, self.values, 0.)
+        n = self._segment_sums(valid.astype(float))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._segment_sums(x) / n
+            centred = np.where(valid, self.values - np.repeat(mean, self.lengths), 0.)
+            std = np.sqrt(self._segment_sums(centred ** 2) / n)
+        std[std == 0] = 1.
+        return self.with_values((self.values - np.repeat(mean, self.lengths)) / np.repeat(std, self.lengths))
+
+    def trend(self, freq=50, model='additive'):
+        # trend_filter on every trace: NaN and zero samples are dropped, the centred moving average is applied to the
+        # compacted samples and the trend is left-aligned and zero-padded to the trace length; traces with fewer than
+        # 2 * freq samples are NaN. One correlate1d pass runs over the whole compacted buffer.
+        valid = ~np.isnan(self.values) & (self.values != 0)
+        compact = self.values[valid]
+        n_valid = self._segment_sums(valid.astype(float)).astype(np.int64)
+        decomposed = n_valid >= 2 * freq
+        if model.startswith('m') and (compact[np.repeat(decomposed, n_valid)] < 0).any():
+            raise ValueError("Multiplicative seasonality is not appropriate for zero and negative values")
+
+        filt = np.array([.5] + [1.] * (freq - 1) + [.5]) / freq if freq % 2 == 0 else np.repeat(1. / freq, freq)
+        half = len(filt) // 2
+        # correlate1d centres the filter on each sample; shifting by half puts window j..j+len(filt)-1 at position j
+        trend = correlate1d(compact, filt, mode='constant')[half:] if len(compact) else compact
+        trend = np.concatenate([trend, np.zeros(len(compact) - len(trend))])
+        compact_offsets = np.concatenate([[0], np.cumsum(n_valid)])
+        position = np.arange(len(compact)) - np.repeat(compact_offsets[:-1], n_valid)
+        owner = np.repeat(np.arange(len(self)), n_valid)
+        inside = position < (n_valid - len(filt) + 1)[owner]
+
+        out = np.zeros(len(self.values))
+        out[self.offsets[owner[inside]] + position[inside]] = trend[inside]
+        out[np.repeat(~decomposed, self.lengths)] = np.nan
+        return self.with_values(out)
+
+    def auc(self, windows, exposure_time=1.0, interpolate=True):
+        # Same windows and table layout as AUCIndex.table, with sample k of every trace at time k * exposure_time;
+        # windows are clipped to each trace's own extent, and a window touching a NaN sample gives NaN
+        if not isinstance(windows, dict):
+            windows = {f'{start}-{end}': (start, end) for start, end in windows}
+        bounds = np.array(list(windows.values()), dtype=float).reshape(-1, 2) / exposure_time
+        starts, ends = bounds[:, 0], bounds[:, 1]
+        if len(self.values) < 2:
+            return pd.concat([self.meta, pd.DataFrame(0., index=self.meta.index, columns=list(windows))], axis=1)
+        # Trapezoids between consecutive samples of the same trace, cumulated over the whole buffer
+        segments = exposure_time * (self.values[1:] + self.values[:-1]) / 2
+        boundaries = self.offsets[(self.offsets > 0) & (self.offsets < len(self.values))]
+        segments[boundaries - 1] = 0.
+        nan_segments = np.isnan(segments)
+        cumulative = np.concatenate([[0.], np.cumsum(np.where(nan_segments, 0., segments))])
+        nan_count = np.concatenate([[0], np.cumsum(nan_segments)])
+
+        last = np.maximum(self.lengths - 1, 0)[:, None]
+        start = self.offsets[:-1, None]
+
+        def at(array, i):
+            # Lookups of traces with fewer than two samples are clamped; their AUC is 0 anyway
+            return array[np.minimum(start + i, len(array) - 1)]
+
+        if interpolate:
+            lo = np.clip(starts[None], 0, last)
+            hi = np.maximum(np.clip(ends[None], 0, last), lo)
+
+            def area_to(x):
+                i = np.clip(np.floor(x), 0, np.maximum(last - 1, 0)).astype(np.int64)
+                v_i = at(self.values, i)
+                v_x = v_i + (at(self.values, i + 1) - v_i) * (x - i)
+                partial = exposure_time * (x - i) * (v_i + v_x) / 2
+                return at(cumulative, i) + np.where(np.isnan(partial), 0., partial), i
+
+            (area_hi, i_hi), (area_lo, i_lo) = area_to(hi), area_to(lo)
+            auc = area_hi - area_lo
+            # Segments from the one containing lo to the one ending at or after hi
+            n_nan = np.where(hi > lo, at(nan_count, np.where(hi > i_hi, i_hi + 1, i_hi)) - at(nan_count, i_lo), 0)
+        else:
+            lo = np.ceil(starts[None]).clip(0, None)
+            hi = np.minimum(np.maximum(np.floor(ends[None]), lo), last)
+            lo, hi = np.minimum(lo, hi).astype(np.int64), hi.astype(np.int64)
+            auc = at(cumulative, hi) - at(cumulative, lo)
+            n_nan = at(nan_count, hi) - at(nan_count, lo)
+        auc = np.where(n_nan > 0, np.nan, auc)
+        auc[self.lengths < 2] = 0.
+        return pd.concat([self.meta, pd.DataFrame(auc, columns=list(windows))], axis=1)
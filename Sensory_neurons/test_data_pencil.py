@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_pencil as dp
+
+def ragged_with_empty_traces():
+    # Empty traces at the start, in the middle and at the end of the buffer
+    rng = np.random.default_rng(0)
+    lengths = [0, 130, 0, 0, 250, 7, 1, 0, 160, 0, 0]
+    traces = [rng.normal(100, 10, n) for n in lengths]
+    traces[4][[3, 40]] = np.nan
+    traces[4][10] = 0.
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    meta = pd.DataFrame({'Cell': [f'cell{i}' for i in range(len(lengths))]})
+    return dp.RaggedTraces(np.concatenate(traces), offsets, meta), traces
+
+def test_segment_sums_with_trailing_empty_traces():
+    rt = dp.RaggedTraces(np.array([1., 2., 3., 4., 5.]), [0, 3, 5, 5])
+    np.testing.assert_array_equal(rt._segment_sums(rt.values), [6., 9., 0.])
+
+def test_zscore_matches_per_row():
+    rt, traces = ragged_with_empty_traces()
+    result = rt.zscore()
+    for i, trace in enumerate(traces):
+        expected = (trace - np.nanmean(trace)) / (np.nanstd(trace) or 1.) if len(trace) else trace
+        np.testing.assert_allclose(result.trace(i), expected, atol=1e-12)
+
+@pytest.mark.parametrize('freq', [1, 7, 10, 50])
+def test_trend_matches_per_row(freq):
+    rt, traces = ragged_with_empty_traces()
+    result = rt.trend(freq)
+    for i, trace in enumerate(traces):
+        expected = dp.trend_filter(trace[None], freq)[0] if len(trace) else trace
+        np.testing.assert_allclose(result.trace(i), expected, atol=1e-9)
+
+def test_trend_from_frame_with_all_nan_last_row():
+    wide = pd.DataFrame(np.random.default_rng(1).normal(50, 5, (3, 600)))
+    wide.iloc[2] = np.nan
+    df = pd.concat([pd.DataFrame({'a': 'e', 'b': range(3), 'c': 1, 'd': 2}), wide], axis=1)
+    trend = dp.RaggedTraces.from_frame(df).trend(50).to_wide(fill_value=0.)
+    expected = dp.decompose_data_rows(df, freq=50)
+    np.testing.assert_allclose(trend.iloc[:2, 4:].to_numpy(), expected.iloc[:2, 4:].to_numpy(), atol=1e-9)
+
+@pytest.mark.parametrize('interpolate', [True, False])
+def test_auc_matches_per_row(interpolate):
+    rt, traces = ragged_with_empty_traces()
+    windows = [(0, 10), (3.3, 17.9), (1.25, 1.75), (-5, 4.1)]
+    result = rt.auc(windows, exposure_time=0.5, interpolate=interpolate).iloc[:, 1:].to_numpy(dtype=float)
+    for i, trace in enumerate(traces):
+        if len(trace) < 2:
+            np.testing.assert_array_equal(result[i], 0.)
+            continue
+        starts, ends = zip(*windows)
+        index = dp.AUCIndex(trace[None], np.arange(len(trace)) * 0.5)
+        np.testing.assert_allclose(result[i], index.query(starts, ends, interpolate)[0], atol=1e-9)
+
+def test_wide_round_trip():
+    rt, traces = ragged_with_empty_traces()
+    back = dp.RaggedTraces.from_frame(rt.to_wide(), n_meta=1)
+    for i, trace in enumerate(traces):
+        np.testing.assert_array_equal(back.trace(i), trace)
+
+def subtract_background_per_row(non_bg_data, bg_data):
+    # The original per-row implementation
+    result = []
+    for exp in non_bg_data['Experiment'].unique():
+        exp_data = non_bg_data[non_bg_data['Experiment'] == exp].copy()
+        exp_bg = bg_data[bg_data['Experiment'] == exp]
+        if not exp_bg.empty:
+            bg_mean = exp_bg.groupby('Timepoint')['Signal'].mean()
+            exp_data['Signal'] = exp_data.apply(lambda row: row['Signal'] - bg_mean[row['Timepoint']], axis=1)
+        result.append(exp_data)
+    return pd.concat(result, ignore_index=True)
+
+def background_frames():
+    rng = np.random.default_rng(2)
+    non_bg = pd.DataFrame({'Experiment': np.repeat(['b', 'a', 'c'], 8), 'Cell': 'cell1',
+                           'Timepoint': np.tile(np.arange(8), 3), 'Signal': rng.normal(100, 5, 24)})
+    # Experiment 'b': timepoint 3 has only NaN background; experiment 'c': all background NaN; 'a' has no background
+    bg = pd.DataFrame({'Experiment': np.repeat(['b', 'c'], 16), 'Cell': 'bg',
+                       'Timepoint': np.tile(np.arange(8), 4), 'Signal': rng.normal(10, 1, 32)})
+    bg.loc[(bg['Experiment'] == 'b') & (bg['Timepoint'] == 3), 'Signal'] = np.nan
+    bg.loc[bg['Experiment'] == 'c', 'Signal'] = np.nan
+    return non_bg, bg
+
+def test_subtract_background_propagates_nan_background():
+    non_bg, bg = background_frames()
+    result = dp.subtract_background(non_bg, bg)
+    expected = subtract_background_per_row(non_bg, bg)
+    pd.testing.assert_frame_equal(result, expected)
+    assert result.loc[result['Experiment'] == 'c', 'Signal'].isna().all()
+    assert result.loc[(result['Experiment'] == 'b') & (result['Timepoint'] == 3), 'Signal'].isna().all()
+    assert result.loc[result['Experiment'] == 'a', 'Signal'].notna().all()
+
+def test_subtract_background_missing_timepoint_is_nan():
+    non_bg, bg = background_frames()
+    bg = bg[~((bg['Experiment'] == 'b') & (bg['Timepoint'] == 5))]
+    result = dp.subtract_background(non_bg, bg)
+    missing = (result['Experiment'] == 'b') & (result['Timepoint'] == 5)
+    assert result.loc[missing, 'Signal'].isna().all()
+    with pytest.raises(KeyError):
+        subtract_background_per_row(non_bg, bg)
+    # Every other row matches the per-row version
+    expected = subtract_background_per_row(non_bg[non_bg['Timepoint'] != 5], bg)
+    pd.testing.assert_frame_equal(result[result['Timepoint'] != 5].reset_index(drop=True), expected)
@@ -0,0 +1,151 @@
+"""
+Stage-level instrumentation shared by the Behavior_data, Brain_imaging and Sensory_neurons pipelines.
+Records wall time, CPU time, the process' max RSS and rows/bytes processed for each stage and input file,
+appends every record to an optional JSON-lines log and prints an end-of-run summary table.
+
+`max_rss_mb` is the ru_maxrss high-water mark of the whole process at the end of the stage, not the memory
+used by the stage itself: it never goes down, so a stage run after a larger one reports the larger value.
+Use `stage(..., trace_memory=True)` (`peak_traced_mb`) for the peak allocated inside one stage.
+
+The modules of the pipelines import this module as `instrumentation`; the repository root has to be on
+sys.path (the `__main__` blocks, `pipeline.py` and the conftest.py files of the test suites take care of it).
+
+    configure('run_log.jsonl')
+    with stage('load_file', file=path) as info:
+        df = pd.read_csv(path)
+        info['rows'] = len(df)
+    print_summary()
+"""
+
+import os
+import sys
+import json
+import time
+import functools
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_records = []
+_log_path = None
+_log_pid = None
+
+def configure(log_path=None, reset=True):
+    global _log_path, _log_pid
+    _log_path = log_path
+    _log_pid = os.getpid()
+    if reset:
+        _records.clear()
+    if log_path:
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+
+def max_rss_mb():
+    # Process-lifetime high-water mark of the resident set size, None where resource is unavailable
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+def get_records():
+    return list(_records)
+
+def add_records(records):
+    # Merges records produced in worker processes into this process' log and summary
+    for record in records:
+        _emit(record)
+
+def _emit(record):
+    _records.append(record)
+    if _log_path and os.getpid() == _log_pid:
+        with open(_log_path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+@contextmanager
+def stage(name, file=None, rows=None, bytes=None, trace_memory=False):
+    info = {'rows': rows, 'bytes': bytes}
+    if file is not None and bytes is None and os.path.isfile(file):
+        info['bytes'] = os.path.getsize(file)
+    traced = trace_memory and not tracemalloc.is_tracing()
+    if traced:
+        tracemalloc.start()
+    elif trace_memory:
+        tracemalloc.reset_peak()
+    started = datetime.now().isoformat(timespec='seconds')
+    wall, cpu = time.perf_counter(), time.process_time()
+    status, error = 'ok', None
+    try:
+        yield info
+    except BaseException as e:
+        status, error = 'error', f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record = {
+            'stage': name,
+            'file': file,
+            'status': status,
+            'error': error,
+            'started': started,
+            'wall_s': round(time.perf_counter() - wall, 6),
+            'cpu_s': round(time.process_time() - cpu, 6),
+            'max_rss_mb': max_rss_mb(),
+            'rows': info.get('rows'),
+            'bytes': info.get('bytes'),
+            'pid': os.getpid(),
+        }
+        if trace_memory:
+            record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            if traced:
+                tracemalloc.stop()
+        info.update(record)
+        _emit(record)
+
+def instrumented(name=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def summarize(records=None):
+    summary = {}
+    for record in _records if records is None else records:
+        entry = summary.setdefault(record['stage'], {'calls': 0, 'errors': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                     'max_wall_s': 0.0, 'max_rss_mb': None, 'rows': 0, 'bytes': 0,
+                                                     'slowest_file': None})
+        entry['calls'] += 1
+        entry['errors'] += record['status'] != 'ok'
+        entry['wall_s'] += record['wall_s']
+        entry['cpu_s'] += record['cpu_s']
+        entry['rows'] += record['rows'] or 0
+        entry['bytes'] += record['bytes'] or 0
+        if record['max_rss_mb'] is not None:
+            entry['max_rss_mb'] = max(entry['max_rss_mb'] or 0.0, record['max_rss_mb'])
+        if record['wall_s'] >= entry['max_wall_s']:
+            entry['max_wall_s'] = record['wall_s']
+            entry['slowest_file'] = record['file']
+    return summary
+
+def print_summary(records=None):
+    summary = summarize(records)
+    if not summary:
+        print("No instrumented stages were recorded.")
+        return summary
+    header = f"{'stage':<32}{'calls':>7}{'errors':>8}{'wall s':>10}{'cpu s':>10}{'max s':>9}{'max RSS MB':>13}{'rows':>12}{'MB in':>9}"
+    print("\n" + header)
+    print("-" * len(header))
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]['wall_s']):
+        peak = f"{entry['max_rss_mb']:.1f}" if entry['max_rss_mb'] is not None else '-'
+        print(f"{name:<32}{entry['calls']:>7}{entry['errors']:>8}{entry['wall_s']:>10.2f}{entry['cpu_s']:>10.2f}"
+              f"{entry['max_wall_s']:>9.2f}{peak:>13}{entry['rows']:>12}{entry['bytes'] / 1e6:>9.1f}")
+    slowest = [(name, e['slowest_file'], e['max_wall_s']) for name, e in summary.items() if e['slowest_file']]
+    for name, file, seconds in sorted(slowest, key=lambda item: -item[2])[:5]:
+        print(f"Slowest {name}: {file} ({seconds:.2f} s)")
+    return summary
@@ -0,0 +1,241 @@
+"""
+Command-line runner for the behavior and brain imaging pipelines.
+Each pipeline is a small DAG of stages (behavior: process -> organize -> trajectories -> probability / kinematics /
+msd, imaging: load -> summary / pca). Every stage result is cached under a hash of the parameters it uses and the
+keys of the stages it depends on (raw input files are fingerprinted by path, size and mtime), so changing one
+parameter only recomputes the stages downstream of it.
+
+    python pipeline.py behavior /data/rheotaxis --output results --rate 10
+    python pipeline.py imaging /data/gcamp --output results --exposure-time 0.673474 --force pca
+"""
+
+import os
+import sys
+import glob
+import json
+import pickle
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(ROOT, 'Behavior_data'), os.path.join(ROOT, 'Brain_imaging')]
+
+from instrumentation import configure, stage, add_records, print_summary
+import data_loading_processing as dlp
+import data_organizing as org
+import behavior_metrics as bm
+from trajectory_set import TrajectorySet
+
+BEHAVIOR_DEFAULTS = {
+    'pixel_size': 25,
+    'rate': 5,
+    'distance_threshold_lower': 100,
+    'distance_threshold_upper': 500,
+    'output_format': 'npz',
+    'min_fragment_length': 10,
+    'exposure_time': 0.2,
+    'offset': 0.061,
+    'angle_bins': 4,
+    'time_window_size': 60,
+    'max_lag': None,
+}
+IMAGING_DEFAULTS = {
+    'exposure_time': 0.673474,
+    'n_components': 10,
+    'pca_chunk_size': None,
+}
+BEHAVIOR_OUTPUTS = ['probability', 'kinematics', 'msd']
+IMAGING_OUTPUTS = ['summary', 'pca']
+PROCESS_PARAMS = ['pixel_size', 'rate', 'distance_threshold_lower', 'distance_threshold_upper', 'output_format']
+
+def files_fingerprint(files):
+    return [(os.path.abspath(f), os.path.getsize(f), os.stat(f).st_mtime_ns) for f in files]
+
+def stage_key(name, params, input_keys, fingerprint=None):
+    payload = json.dumps({'stage': name, 'params': params, 'inputs': input_keys, 'files': fingerprint},
+                         sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+def stage_keys(stages, params):
+    # Stages are listed in topological order, so every dependency already has its key
+    keys = {}
+    for name, spec in stages.items():
+        fingerprint = files_fingerprint(spec['files'](params)) if spec.get('files') else None
+        used = {p: params[p] for p in spec['params']}
+        keys[name] = stage_key(name, used, [keys[dep] for dep in spec['deps']], fingerprint)
+    return keys
+
+def run_pipeline(stages, params, cache_dir, targets=None, force=()):
+    # Only the requested targets and whatever they need are evaluated; a cached stage is loaded without touching its
+    # inputs, so a fully cached run never reads the raw data
+    os.makedirs(cache_dir, exist_ok=True)
+    keys = stage_keys(stages, params)
+    results = {}
+
+    def get(name):
+        if name in results:
+            return results[name]
+        spec, key = stages[name], keys[name]
+        path = os.path.join(cache_dir, f'{name}-{key}.pkl')
+        if name not in force and os.path.exists(path):
+            print(f"[CACHED] {name} ({key})")
+            with stage(f'pipeline:{name}', file=path):
+                with open(path, 'rb') as f:
+                    results[name] = pickle.load(f)
+            return results[name]
+        inputs = [get(dep) for dep in spec['deps']]
+        print(f"[RUN] {name} ({key})")
+        with stage(f'pipeline:{name}'):
+            results[name] = spec['func'](params, os.path.join(cache_dir, f'{name}-{key}'), *inputs)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(results[name], f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        return results[name]
+
+    for name in targets or stages:
+        get(name)
+    return results, keys
+
+# Behavior stages
+
+def behavior_process(params, workdir):
+    # Outputs go to a folder named after the stage key, mirroring the stimulus/day folders of the raw data so that
+    # data_organizing can read them; a different parameter set never overwrites another one's files
+    experiment_folder = params['experiment_folder']
+    process_params = {p: params[p] for p in PROCESS_PARAMS}
+    jobs = []
+    for file in dlp.find_dlc_files(experiment_folder):
+        target = os.path.join(workdir, os.path.relpath(os.path.dirname(file), experiment_folder))
+        os.makedirs(target, exist_ok=True)
+        jobs.append((file, target, process_params))
+    if params['n_workers'] == 1:
+        outcomes = [dlp._process_csv_worker(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=params['n_workers']) as executor:
+            outcomes = list(executor.map(dlp._process_csv_worker, *zip(*jobs))) if jobs else []
+        for _, _, records in outcomes:
+            add_records(records)
+    skipped = [file for file, ok, _ in outcomes if not ok]
+    if skipped:
+        print(f"{len(skipped)} files were skipped due to errors.")
+    return {'folder': workdir, 'skipped': skipped}
+
+def behavior_organize(params, workdir, processed):
+    source = 'csv' if params['output_format'] == 'csv' else 'npz'
+    return org.process_all(processed['folder'], source=source)
+
+def behavior_trajectories(params, workdir, organized):
+    ts = TrajectorySet.from_frames(*organized)
+    return bm.trajectory_filter_fragments(ts, params['min_fragment_length'])
+
+def behavior_probability(params, workdir, ts):
+    edges = np.linspace(0, 2 * np.pi, params['angle_bins'] + 1)
+    return bm.trajectory_probability(ts, list(zip(edges[:-1], edges[1:])), params['time_window_size'],
+                                     offset=params['offset'])
+
+def behavior_kinematics(params, workdir, ts):
+    # Per-track summary of the fused kinematics
+    kin = bm.trajectory_kinematics(ts, params['exposure_time'], params['offset'])
+    table = ts.meta.copy()
+    valid = ~np.isnan(kin['speed'])
+    omega_valid = ~np.isnan(kin['omega'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table['mean_speed'] = np.where(valid, kin['speed'], 0.).sum(axis=1) / valid.sum(axis=1)
+        table['mean_abs_omega'] = np.where(omega_valid, np.abs(kin['omega']), 0.).sum(axis=1) / omega_valid.sum(axis=1)
+    table['total_distance'] = np.nansum(kin['distance'], axis=1)
+    table['valid_frames'] = valid.sum(axis=1)
+    return table
+
+def behavior_msd(params, workdir, ts):
+    return bm.trajectory_msd(ts, max_lag=params['max_lag'])
+
+BEHAVIOR_STAGES = {
+    'process': {'func': behavior_process, 'deps': [], 'params': PROCESS_PARAMS,
+                'files': lambda params: dlp.find_dlc_files(params['experiment_folder'])},
+    'organize': {'func': behavior_organize, 'deps': ['process'], 'params': []},
+    'trajectories': {'func': behavior_trajectories, 'deps': ['organize'], 'params': ['min_fragment_length']},
+    'probability': {'func': behavior_probability, 'deps': ['trajectories'],
+                    'params': ['angle_bins', 'time_window_size', 'offset']},
+    'kinematics': {'func': behavior_kinematics, 'deps': ['trajectories'], 'params': ['exposure_time', 'offset']},
+    'msd': {'func': behavior_msd, 'deps': ['trajectories'], 'params': ['max_lag']},
+}
+
+# Imaging stages
+
+def imaging_files(params):
+    return sorted(glob.glob(os.path.join(params['directory'], '*.csv')))
+
+def imaging_load(params, workdir):
+    # The imaging modules are imported on use: they pull in sklearn/tslearn, which the behavior pipeline does not need
+    from data_loading import load_data
+    return load_data(params['directory'], n_workers=params['n_workers'], use_cache=False, save_csv=False)
+
+def imaging_summary(params, workdir, merged_df):
+    # Per strength and phase: z-score, PCA and region summary scores (as in main.py)
+    from brain_analysis import prepare_custom_datasets, generate_and_save_summary_data
+    subsets = prepare_custom_datasets(merged_df)
+    summary_data = generate_and_save_summary_data(subsets, workdir, params['exposure_time'], n_workers=params['n_workers'])
+    return pd.DataFrame.from_dict({(i, j): summary_data[i][j]
+                                   for i in summary_data.keys()
+                                   for j in summary_data[i].keys()}, orient='index').round(3)
+
+def imaging_pca(params, workdir, merged_df):
+    from pca_analysis import perform_pca_on_entire_dataset
+    pca, explained_variance = perform_pca_on_entire_dataset(merged_df, n_components=params['n_components'],
+                                                            chunk_size=params['pca_chunk_size'])
+    return {'pca': pca, 'explained_variance': explained_variance}
+
+IMAGING_STAGES = {
+    'load': {'func': imaging_load, 'deps': [], 'params': [], 'files': imaging_files},
+    'summary': {'func': imaging_summary, 'deps': ['load'], 'params': ['exposure_time']},
+    'pca': {'func': imaging_pca, 'deps': ['load'], 'params': ['n_components', 'pca_chunk_size']},
+}
+
+def optional_int(value):
+    return None if value.lower() == 'none' else int(value)
+
+def write_outputs(results, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    for name, result in results.items():
+        if isinstance(result, pd.DataFrame):
+            result.to_csv(os.path.join(output_dir, f'{name}.csv'), index=not isinstance(result.index, pd.RangeIndex))
+        elif name == 'pca' and result['pca'] is not None:
+            pd.DataFrame({'explained_variance': result['explained_variance']},
+                         index=[f'PC{i + 1}' for i in range(len(result['explained_variance']))]
+                         ).to_csv(os.path.join(output_dir, 'pca_explained_variance.csv'))
+    print(f"Results saved to {output_dir}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='pipeline', required=True)
+    for name, defaults, stages, folder in (('behavior', BEHAVIOR_DEFAULTS, BEHAVIOR_STAGES, 'experiment_folder'),
+                                           ('imaging', IMAGING_DEFAULTS, IMAGING_STAGES, 'directory')):
+        sub = subparsers.add_parser(name)
+        sub.add_argument(folder, help='raw data folder')
+        sub.add_argument('--output', default='pipeline_results')
+        sub.add_argument('--cache-dir', default=None, help='defaults to <output>/.cache')
+        sub.add_argument('--workers', type=int, default=os.cpu_count())
+        sub.add_argument('--targets', nargs='+', choices=list(stages), default=None,
+                         help='stages to evaluate (default: the final results)')
+        sub.add_argument('--force', nargs='+', choices=list(stages), default=[], help='recompute these stages')
+        for param, default in defaults.items():
+            sub.add_argument('--' + param.replace('_', '-'), default=default,
+                             type=type(default) if default is not None else optional_int)
+    args = vars(parser.parse_args(argv))
+
+    stages, outputs = ((BEHAVIOR_STAGES, BEHAVIOR_OUTPUTS) if args['pipeline'] == 'behavior'
+                       else (IMAGING_STAGES, IMAGING_OUTPUTS))
+    params = dict(args, n_workers=args['workers'])
+    cache_dir = args['cache_dir'] or os.path.join(args['output'], '.cache')
+    targets = args['targets'] or outputs
+    configure(os.path.join(args['output'], 'instrumentation.jsonl'))
+    results, keys = run_pipeline(stages, params, cache_dir, targets, set(args['force']))
+    write_outputs({name: results[name] for name in targets if name in outputs}, args['output'])
+    print_summary()
+    return results
+
+if __name__ == '__main__':
+    main()